@@ -0,0 +1,174 @@
+import random
+import time
+
+import state as state_module
+from state import State, Box
+from monte import mcts, MCTSNode, Rave
+
+# Generate boxes of random size, as in simulation.py, without importing matplotlib
+def generate_random_boxes(n_boxes: int, max_width: int, max_height: int, max_depth: int, orientations='any'):
+    return [Box(random.randint(1, max_width), random.randint(1, max_height), random.randint(1, max_depth), i, orientations) for i in range(1, n_boxes + 1)]
+
+# A rollout that lists every legal action at each step and places boxes with apply(),
+# to compare against the sampling kernel in MCTSNode.rollout
+def listing_rollout(state: State):
+    state = state.clone()
+    actions = state.get_possible_actions()
+    while actions:
+        state.apply(random.choice(actions))
+        actions = state.get_possible_actions()
+    return MCTSNode.evaluate_state(state)
+
+# Rollouts per second from a fresh packing, with the listing rollout and the sampling kernel
+def bench_rollouts(instances=((10, 10, 10, 40, 5), (20, 20, 20, 100, 8)), seconds=2.0):
+    print('Rollouts per second: listing every action vs sampling one')
+    print(f'{"container":>12} {"boxes":>6} {"listing":>10} {"sampling":>10}')
+    for width, height, depth, n_boxes, max_size in instances:
+        random.seed(0)
+        node = MCTSNode(State(width, height, depth, generate_random_boxes(n_boxes, max_size, max_size, max_size)))
+        rates = []
+        for rollout in (lambda: listing_rollout(node.state), node.rollout):
+            rollouts = 0
+            start_time = time.perf_counter()
+            while time.perf_counter() - start_time < seconds:
+                rollout()
+                rollouts += 1
+            rates.append(rollouts / (time.perf_counter() - start_time))
+        container = f'{width}x{height}x{depth}'
+        print(f'{container:>12} {n_boxes:>6} {rates[0]:>10.1f} {rates[1]:>10.1f}')
+
+# Pack a whole instance with one mcts() call per move, reusing the subtree each time, and
+# return the fraction of the container filled
+def pack_fill_rate(state: State, iterations, **options):
+    root_node = None
+    while not state.is_terminal():
+        action, root_node = mcts(state, iterations, root_node=root_node, return_node=True, **options)
+        state = state.perform_action(action)
+    return state.placed_volume / (state.width * state.height * state.depth)
+
+# Mean fill rate of plain UCT and RAVE at increasing iterations per move, and the fewest
+# iterations at which each reaches target_fill
+def bench_rave(iteration_counts=(10, 25, 50, 100), target_fill=0.78, seeds=4, width=10, height=10, depth=10, n_boxes=30, max_size=6):
+    print(f'UCT vs RAVE: mean fill rate over {seeds} packings of {n_boxes} boxes in {width}x{height}x{depth}')
+    modes = (('uct', {}), ('rave', {'rave': Rave()}))
+    print(f'{"iterations":>10} ' + ' '.join(f'{name:>8}' for name, _ in modes))
+    reached = {}
+    for iterations in iteration_counts:
+        fill_rates = []
+        for name, options in modes:
+            total = 0.0
+            for seed in range(seeds):
+                random.seed(seed)
+                state = State(width, height, depth, generate_random_boxes(n_boxes, max_size, max_size, max_size))
+                total += pack_fill_rate(state, iterations, **options)
+            fill_rates.append(total / seeds)
+            if total / seeds >= target_fill:
+                reached.setdefault(name, iterations)
+        print(f'{iterations:>10} ' + ' '.join(f'{fill_rate:>8.4f}' for fill_rate in fill_rates))
+    for name, _ in modes:
+        print(f'{name} reaches {target_fill:.0%} fill at {reached.get(name, "more than " + str(iteration_counts[-1]))} iterations per move')
+
+# Free-space count and get_possible_actions time as boxes are placed bottom-left first, one
+# row per report_every boxes, then the time of one search move on a smaller instance, which
+# is where the space bookkeeping and action generation end up being paid for
+def bench_spaces(width=30, height=30, depth=30, n_boxes=800, max_size=6, report_every=100, repeats=3, search_instance=(20, 20, 20, 60, 10), search_iterations=100):
+    random.seed(0)
+    state = State(width, height, depth, generate_random_boxes(n_boxes, max_size, max_size, max_size))
+    print(f'Free spaces vs boxes placed in {width}x{height}x{depth}')
+    print(f'{"placed":>8} {"spaces":>8} {"actions":>8} {"ms/call":>10}')
+    placed = 0
+    while True:
+        if placed % report_every == 0:
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                actions = state.get_possible_actions()
+            elapsed = time.perf_counter() - start_time
+            print(f'{placed:>8} {len(state.available_spaces):>8} {len(actions):>8} {1e3 * elapsed / repeats:>10.2f}')
+        action = state.lowest_fit_action()
+        if action is None:
+            break
+        state.apply(action)
+        placed += 1
+    print(f'{placed} boxes placed, {state.placed_volume / (width * height * depth):.1%} of the container filled')
+    width, height, depth, n_boxes, max_size = search_instance
+    random.seed(0)
+    state = State(width, height, depth, generate_random_boxes(n_boxes, max_size, max_size, max_size))
+    start_time = time.perf_counter()
+    mcts(state, iterations=search_iterations)
+    print(f'One {search_iterations}-iteration mcts move on {n_boxes} boxes in {width}x{height}x{depth}: {time.perf_counter() - start_time:.2f} s')
+
+# A random legal action found by trying random (space, box, rotation) triples, falling back to
+# the bottom-left fill. Cheaper than sample_action when there are many boxes and spaces
+def scattered_action(state: State, rng, attempts=200):
+    spaces = list(state.available_spaces)
+    for _ in range(attempts):
+        space = rng.choice(spaces)
+        box = rng.choice(state.boxes_to_place)
+        rotation = rng.choice(box.get_rotations())
+        if state.can_place_item(space, rotation):
+            return (box, space[0], rotation)
+    return state.lowest_fit_action()
+
+# Time in-place placements as the number of free spaces grows, scanning the space list and
+# with the space grid. Boxes are placed at random positions, which leaves thousands of spaces
+def bench_placement_vs_spaces(width=30, height=30, depth=30, n_boxes=1500, max_size=6, placements=700, report_every=100):
+    random.seed(0)
+    boxes = generate_random_boxes(n_boxes, max_size, max_size, max_size)
+    state = State(width, height, depth, boxes)
+    rng = random.Random(0)
+    actions = []
+    while len(actions) < placements and state.boxes_to_place:
+        action = scattered_action(state, rng)
+        if action is None:
+            break
+        state.play(action)
+        actions.append(action)
+    print(f'Per-placement cost vs free spaces in {width}x{height}x{depth}: scan vs grid')
+    print(f'{"placed":>8} {"spaces":>8} {"scan us":>10} {"grid us":>10}')
+    threshold = state_module.index_threshold
+    rows = []
+    for forced_threshold in (float('inf'), threshold):
+        state_module.index_threshold = forced_threshold
+        state = State(width, height, depth, boxes)
+        elapsed = 0.0
+        for placed, action in enumerate(actions, 1):
+            start_time = time.perf_counter()
+            state.play(action)
+            elapsed += time.perf_counter() - start_time
+            if placed % report_every == 0:
+                rows.append((placed, len(state.available_spaces), 1e6 * elapsed / report_every))
+                elapsed = 0.0
+    state_module.index_threshold = threshold
+    half = len(rows) // 2
+    for (placed, spaces, scan), (_, _, grid) in zip(rows[:half], rows[half:]):
+        print(f'{placed:>8} {spaces:>8} {scan:>10.1f} {grid:>10.1f}')
+
+# Action count and get_possible_actions time for the same boxes under each orientation mask,
+# part way through a bottom-left packing
+def bench_orientations(width=20, height=20, depth=20, n_boxes=200, max_size=6, placements=40, repeats=20):
+    print(f'get_possible_actions by orientation mask, {placements} boxes into {width}x{height}x{depth}')
+    print(f'{"mask":>14} {"rotations":>10} {"actions":>8} {"ms/call":>10}')
+    for orientations in state_module.orientation_masks:
+        random.seed(0)
+        state = State(width, height, depth, generate_random_boxes(n_boxes, max_size, max_size, max_size, orientations))
+        for _ in range(placements):
+            action = state.lowest_fit_action()
+            if action is None:
+                break
+            state.apply(action)
+        rotations = sum(len(box.get_rotations()) for box in state.boxes_to_place)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            actions = state.get_possible_actions()
+        elapsed = time.perf_counter() - start_time
+        print(f'{orientations:>14} {rotations:>10} {len(actions):>8} {1e3 * elapsed / repeats:>10.2f}')
+
+def main():
+    bench_spaces()
+    bench_placement_vs_spaces()
+    bench_orientations()
+    bench_rollouts()
+    bench_rave()
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,20 @@
 import numpy as np
 from state import State
 
+# Volume covered by a list of spaces, counting each point once however many spaces overlap it.
+# The spaces are cut along all their faces into cells and the covered cells are added up
+def covered_volume(spaces):
+    if not spaces:
+        return 0
+    xs = sorted({x for (x0, _, _), (x1, _, _) in spaces for x in (x0, x1)})
+    ys = sorted({y for (_, y0, _), (_, y1, _) in spaces for y in (y0, y1)})
+    zs = sorted({z for (_, _, z0), (_, _, z1) in spaces for z in (z0, z1)})
+    covered = np.zeros((len(xs) - 1, len(ys) - 1, len(zs) - 1), dtype=bool)
+    for (x0, y0, z0), (x1, y1, z1) in spaces:
+        covered[xs.index(x0):xs.index(x1), ys.index(y0):ys.index(y1), zs.index(z0):zs.index(z1)] = True
+    cell_volumes = np.diff(xs)[:, None, None] * np.diff(ys)[None, :, None] * np.diff(zs)[None, None, :]
+    return int(cell_volumes[covered].sum())
+
 def extract_features(state: State):
     features = []
     
@@ -68,7 +82,8 @@ def extract_features(state: State):
     
     # Available spaces statistics
     num_spaces = len(state.available_spaces)
-    total_available_volume = sum((x1 - x0) * (y1 - y0) * (z1 - z0) for (x0, y0, z0), (x1, y1, z1) in state.available_spaces)
+    # The spaces overlap, so their volumes are not simply summed
+    total_available_volume = covered_volume(state.available_spaces)
     largest_space = max([(x1 - x0) * (y1 - y0) * (z1 - z0) for (x0, y0, z0), (x1, y1, z1) in state.available_spaces], default=0)
     features.extend([num_spaces, total_available_volume, largest_space])
     
@@ -1,70 +1,960 @@
 import math
 import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
 from state import State, Box
 
+# Rollout policies take a state and return the action to play next, or None once no box fits.
+# They are module-level functions or picklable objects so root-parallel workers can use them
+def random_policy(state: State):
+    return state.sample_action()
+
+# The next FFDH move: the largest box that still fits, in the lowest layer it fits in
+def largest_area_policy(state: State):
+    return state.largest_first_action()
+
+# Bottom-left fill: the lowest free space, filled with the largest box that fits there
+def lowest_layer_policy(state: State):
+    return state.lowest_fit_action()
+
+# Follow a heuristic policy, but play a uniformly random action with probability epsilon
+class EpsilonGreedyPolicy:
+    def __init__(self, policy=largest_area_policy, epsilon=0.1):
+        self.policy = policy
+        self.epsilon = epsilon
+
+    def __call__(self, state: State):
+        if random.random() < self.epsilon:
+            return state.sample_action()
+        return self.policy(state)
+
+rollout_policies = {
+    'random': random_policy,
+    'largest_area': largest_area_policy,
+    'lowest_layer': lowest_layer_policy,
+    'epsilon_greedy': EpsilonGreedyPolicy(),
+}
+
+# Look up a rollout policy by name in rollout_policies. Callables are returned as they are
+def get_rollout_policy(policy):
+    if callable(policy):
+        return policy
+    if policy not in rollout_policies:
+        raise ValueError(f"Unknown rollout policy {policy!r}, expected one of {sorted(rollout_policies)}")
+    return rollout_policies[policy]
+
+# Progressive widening: a node with n visits may have at most ceil(constant * n^alpha)
+# children, and expands its actions best first by the state's prioritised_actions()
+class ProgressiveWidening:
+    def __init__(self, alpha=0.5, constant=2.0):
+        self.alpha = alpha
+        self.constant = constant
+
+    def allowed_children(self, visits):
+        return math.ceil(self.constant * max(visits, 1) ** self.alpha)
+
+# The best rollout reward found so far in one search. A rollout stops as soon as its state's
+# upper_bound() falls below it, and selection skips children whose bound already has
+class Incumbent:
+    def __init__(self):
+        self.value = -math.inf
+
+    def update(self, reward):
+        if reward > self.value:
+            self.value = reward
+
+# Rapid action value estimation. Selection blends a child's mean reward with the
+# all-moves-as-first (AMAF) mean of its action: the mean reward of every simulation through
+# the parent that made the same move at any later point, in the tree or in the rollout. The
+# AMAF weight fades as the child's own visits grow past equivalence
+class Rave:
+    def __init__(self, equivalence=100):
+        self.equivalence = equivalence
+
+    def weight(self, visits):
+        return math.sqrt(self.equivalence / (3 * visits + self.equivalence))
+
 class MCTSNode:
-    def __init__(self, state: State, parent=None, action=None):
+    # Without a rollout_policy, widening or rave a node uses its parent's. A root defaults to
+    # random_policy, to expanding every action before selecting among its children, and to plain UCT
+    def __init__(self, state: State, parent=None, action=None, rollout_policy=None, widening=None, rave=None):
         self.state = state
         self.parent = parent
         self.action = action  # The action that led to this state
+        if rollout_policy is None:
+            rollout_policy = parent.policy if parent is not None else random_policy
+        self.policy = rollout_policy
+        if widening is None and parent is not None:
+            widening = parent.widening
+        self.widening = widening
+        if rave is None and parent is not None:
+            rave = parent.rave
+        self.rave = rave
+        if rave is not None:
+            self.amaf = {}  # Action key -> [simulations that made the move below this node, their total reward]
+            self.action_key = state.action_key(action) if action is not None else None
         self.children = []
         self.visits = 0
         self.reward = 0.0
-        self.untried_actions = state.get_possible_actions()
+        # Actions not expanded yet are drawn from the state's action generator one at a time,
+        # keeping at most the next one in untried_actions, so a node that is never expanded
+        # never lists its actions
+        self.untried_actions = []
+        self.action_iterator = state.iter_actions()
+        self.lock = threading.Lock()  # Guards expansion and statistics when threads share the tree
+
+    # The untried actions, with the next one drawn from the generator if the list has run dry.
+    # With progressive widening or RAVE the whole list is built and ordered on the first call
+    # instead, best last so pop() takes it first. Callers sharing the node between threads hold its lock
+    def untried(self):
+        if (self.widening is not None or self.rave is not None) and self.action_iterator is not None:
+            self.untried_actions = self.state.prioritised_actions()[::-1]
+            self.action_iterator = None
+        if not self.untried_actions and self.action_iterator is not None:
+            action = next(self.action_iterator, None)
+            if action is None:
+                self.action_iterator = None
+            else:
+                self.untried_actions.append(action)
+        return self.untried_actions
 
     def is_fully_expanded(self):
-        return len(self.untried_actions) == 0
+        with self.lock:
+            return not self.untried()
+
+    # True if the node has an untried action and, under progressive widening, room for another child
+    def can_expand(self):
+        with self.lock:
+            if not self.untried():
+                return False
+            return self.widening is None or len(self.children) < self.widening.allowed_children(self.visits)
+
+    # A node with no children and nothing left to expand has no legal action
+    def is_terminal(self):
+        return not self.children and self.is_fully_expanded()
 
-    def best_child(self, c_param=1.4):
-        choices_weights = [
-            (child.reward / child.visits) + c_param * math.sqrt(2 * math.log(self.visits) / child.visits)
-            for child in self.children
-        ]
-        return self.children[choices_weights.index(max(choices_weights))]
+    def best_child(self, c_param=1.4, incumbent=None):
+        children = list(self.children)
+        if incumbent is not None:
+            # Skip children that cannot beat the best packing found, unless none of them can
+            children = [child for child in children if child.state.upper_bound() >= incumbent.value] or children
+        log_visits = math.log(max(self.visits, 1))
+        # RAVE only steers the search. The final move (c_param=0) goes by the children's own means
+        rave = self.rave if c_param else None
+        choices_weights = []
+        for child in children:
+            if not child.visits:
+                # A child another thread has only just added has no visits yet, so it is tried first
+                choices_weights.append(math.inf)
+                continue
+            mean = child.reward / child.visits
+            if rave is not None:
+                amaf = self.amaf.get(child.action_key)
+                if amaf:
+                    beta = rave.weight(child.visits)
+                    mean = (1 - beta) * mean + beta * amaf[1] / amaf[0]
+            choices_weights.append(mean + c_param * math.sqrt(2 * log_visits / child.visits))
+        return children[choices_weights.index(max(choices_weights))]
 
+    # The AMAF mean reward of an action from this node, or -inf if no simulation has made it
+    def amaf_mean(self, action):
+        amaf = self.amaf.get(self.state.action_key(action))
+        return amaf[1] / amaf[0] if amaf else -math.inf
+
+    # Expand one untried action. Returns None if another thread took the last one first
     def expand(self):
-        action = self.untried_actions.pop()
+        with self.lock:
+            untried = self.untried()
+            if not untried:
+                return None
+            if self.rave is not None and self.amaf:
+                # Expand the action with the best AMAF mean, falling back on the prior order
+                index = max(range(len(untried)), key=lambda i: (self.amaf_mean(untried[i]), i))
+                action = untried.pop(index)
+            else:
+                action = untried.pop()
         next_state = self.state.perform_action(action)
         child_node = MCTSNode(next_state, parent=self, action=action)
-        self.children.append(child_node)
+        with self.lock:
+            self.children.append(child_node)
         return child_node
 
-    def rollout_policy(self, possible_actions):
-        return random.choice(possible_actions)
+    # Count an in-flight simulation as a visit with no reward, so concurrent threads pick other paths
+    def add_virtual_loss(self, virtual_loss):
+        if virtual_loss:
+            with self.lock:
+                self.visits += virtual_loss
 
-    def rollout(self):
+    def rollout_policy(self, state):
+        return self.policy(state)
+
+    # With an incumbent, a rollout that can no longer beat it stops early and scores what it
+    # has placed so far; a finished rollout that beats it becomes the new incumbent. Each
+    # action played is appended to played, if given
+    def rollout(self, incumbent=None, played=None):
+        # Clone once into a scratch state and place boxes on it without undo records
         current_state = self.state.clone()
-        while current_state.boxes_to_place and current_state.get_possible_actions():
-            action = self.rollout_policy(current_state.get_possible_actions())
-            current_state = current_state.perform_action(action)
-        return self.evaluate_state(current_state)
+        action = self.rollout_policy(current_state)
+        while action is not None:
+            if incumbent is not None and current_state.upper_bound() < incumbent.value:
+                return self.evaluate_state(current_state)
+            current_state.play(action)
+            if played is not None:
+                played.append(action)
+            action = self.rollout_policy(current_state)
+        reward = self.evaluate_state(current_state)
+        if incumbent is not None:
+            incumbent.update(reward)
+        return reward
 
-    def backpropagate(self, reward):
-        self.visits += 1
-        self.reward += reward
-        if self.parent:
-            self.parent.backpropagate(reward)
+    # Run several rollouts from this node and return their mean, for a lower-variance estimate
+    # from a single selection. played, if given, collects each rollout's actions with its reward
+    def rollout_batch(self, rollouts=1, incumbent=None, played=None):
+        total = 0
+        for _ in range(rollouts):
+            actions = [] if played is not None else None
+            reward = self.rollout(incumbent, actions)
+            if played is not None:
+                played.append((actions, reward))
+            total += reward
+        return total if rollouts == 1 else total / rollouts
 
-    def tree_policy(self):
+    # Add the reward to every node on a path from select_path, removing the virtual loss it
+    # applied. With RAVE, played holds each rollout's actions and reward from rollout_batch, and
+    # each node's AMAF statistics are credited once per rollout for every move made below it,
+    # with that rollout's own reward
+    @staticmethod
+    def backpropagate_path(path, reward, virtual_loss=0, played=None):
+        runs = None
+        if played is not None:
+            path_keys = [node.action_key for node in path[1:]]
+            state = path[-1].state
+            runs = [(path_keys + [state.action_key(action) for action in actions], run_reward) for actions, run_reward in played]
+        for depth, node in enumerate(path):
+            with node.lock:
+                node.visits += 1 - virtual_loss
+                node.reward += reward
+                if runs is not None:
+                    for keys, run_reward in runs:
+                        for key in dict.fromkeys(keys[depth:]):
+                            amaf = node.amaf.get(key)
+                            if amaf is None:
+                                node.amaf[key] = [1, run_reward]
+                            else:
+                                amaf[0] += 1
+                                amaf[1] += run_reward
+
+    # Descend to the node to simulate from, returning every node on the way, starting with this one
+    def select_path(self, virtual_loss=0, incumbent=None):
         current_node = self
-        while current_node.state.boxes_to_place and current_node.state.get_possible_actions():
-            if not current_node.is_fully_expanded():
-                return current_node.expand()
-            else:
-                current_node = current_node.best_child()
-        return current_node
+        current_node.add_virtual_loss(virtual_loss)
+        path = [current_node]
+        while not current_node.is_terminal():
+            if current_node.can_expand():
+                child_node = current_node.expand()
+                if child_node is not None:
+                    child_node.add_virtual_loss(virtual_loss)
+                    path.append(child_node)
+                    return path
+            if not current_node.children:
+                # Another thread is still expanding this node's only action
+                return path
+            current_node = current_node.best_child(incumbent=incumbent)
+            current_node.add_virtual_loss(virtual_loss)
+            path.append(current_node)
+        return path
 
-    def evaluate_state(self, state):
+    @staticmethod
+    def evaluate_state(state):
         # Define a reward function based on the total volume of placed boxes
-        total_volume = sum((action[0].width * action[0].height * action[0].depth for action in state.action_history))
-        return total_volume
-
-def mcts(root_state, iterations=1000):
-    root_node = MCTSNode(root_state)
-    for _ in range(iterations):
-        node = root_node.tree_policy()
-        reward = node.rollout()
-        node.backpropagate(reward)
-    # Select the action corresponding to the best child
-    best_child = root_node.best_child(c_param=0)
-    return best_child.action
+        return state.placed_volume
+
+# A node shared by every path that reaches the same state. Visit counts through each
+# incoming action are kept separately, on the parent's edges
+class TranspositionNode(MCTSNode):
+    def __init__(self, state: State, rollout_policy=None):
+        super().__init__(state, rollout_policy=rollout_policy)
+        self.edges = {}  # action -> [visits through this action, child node]
+
+    def is_terminal(self):
+        return not self.untried() and not self.edges
+
+    # UCT on a DAG: exploit with the child's shared mean reward, explore with the edge's own visit count
+    def best_edge(self, c_param=1.4):
+        log_visits = math.log(self.visits)
+        best_weight = -math.inf
+        best = None
+        for action, edge in self.edges.items():
+            edge_visits, child = edge
+            if child.visits == 0:
+                # Rebuilt after eviction: explore it first, but never pick it as the final move
+                weight = math.inf if c_param else -math.inf
+            else:
+                weight = (child.reward / child.visits) + c_param * math.sqrt(2 * log_visits / edge_visits)
+            if best is None or weight > best_weight:
+                best_weight = weight
+                best = (action, edge)
+        return best
+
+# Nodes keyed by state (Zobrist hash plus equality), least recently used first. Once the
+# table is full the least recently used node is evicted and its state freed. Nodes looked up
+# or touched since the last release() are pinned: the search is still walking through them,
+# so they are never evicted, and the table grows past max_size if every node is pinned
+class TranspositionTable:
+    def __init__(self, max_size=100000, rollout_policy=random_policy):
+        self.max_size = max_size
+        self.rollout_policy = rollout_policy
+        self.nodes = OrderedDict()
+        self.pinned = set()  # ids of the pinned nodes
+        self.peak = 0  # Most nodes held at once since the current search started
+
+    # Return the node for a state, creating it if the state has not been seen, and pin it
+    def lookup(self, state: State):
+        node = self.nodes.get(state)
+        if node is None:
+            node = TranspositionNode(state, self.rollout_policy)
+            node.table = self
+            self.nodes[state] = node
+            self.pinned.add(id(node))
+            while len(self.nodes) > self.max_size and self.evict():
+                pass
+            self.peak = max(self.peak, len(self.nodes))
+        else:
+            self.nodes.move_to_end(state)
+            self.pinned.add(id(node))
+        return node
+
+    # Mark a node as just used and pin it
+    def touch(self, node: TranspositionNode):
+        self.nodes.move_to_end(node.state)
+        self.pinned.add(id(node))
+
+    # Unpin every node, at the start of a new descent from the root
+    def release(self):
+        self.pinned.clear()
+
+    # Drop the least recently used node that is not pinned, returning False if every node is.
+    # Edges still pointing at it rebuild the child on their next visit
+    def evict(self):
+        for state, node in self.nodes.items():
+            if id(node) not in self.pinned:
+                break
+        else:
+            return False
+        del self.nodes[state]
+        node.state = None
+        node.untried_actions = []
+        node.action_iterator = None
+        node.edges = {}
+        return True
+
+# MCTS tree held as parallel NumPy arrays instead of MCTSNode objects. A node's children
+# occupy one contiguous block (first_child .. first_child + num_children), so UCT is a single
+# argmax over a slice. Nodes keep no State: one scratch state is walked down with apply()
+# and back up with undo() on every iteration
+class ArrayTree:
+    def __init__(self, root_state: State, capacity=1024, rollout_policy=random_policy):
+        self.state = root_state.clone()
+        self.policy = rollout_policy
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+        self.parents = np.full(capacity, -1, dtype=np.int64)
+        self.first_child = np.full(capacity, -1, dtype=np.int64)
+        self.num_children = np.zeros(capacity, dtype=np.int64)
+        self.action_codes = np.full(capacity, -1, dtype=np.int64)
+        self.expanded = np.zeros(capacity, dtype=bool)
+        self.actions = []  # Action code -> action
+        self.codes = {}  # Action -> action code
+        self.size = 1  # Node 0 is the root
+
+    def _grow(self, needed):
+        capacity = len(self.visits)
+        while capacity < needed:
+            capacity *= 2
+        for name in ('visits', 'rewards', 'parents', 'first_child', 'num_children', 'action_codes', 'expanded'):
+            old = getattr(self, name)
+            new = np.full(capacity, -1 if name in ('parents', 'first_child', 'action_codes') else 0, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _action_code(self, action):
+        code = self.codes.get(action)
+        if code is None:
+            code = self.codes[action] = len(self.actions)
+            self.actions.append(action)
+        return code
+
+    # Allocate one contiguous block of children for every legal action of the scratch state
+    def _expand(self, node):
+        actions = self.state.get_possible_actions()
+        self.expanded[node] = True
+        if not actions:
+            return
+        start = self.size
+        if start + len(actions) > len(self.visits):
+            self._grow(start + len(actions))
+        self.first_child[node] = start
+        self.num_children[node] = len(actions)
+        self.parents[start:start + len(actions)] = node
+        self.action_codes[start:start + len(actions)] = [self._action_code(action) for action in actions]
+        self.size += len(actions)
+
+    def best_child(self, node, c_param=1.4):
+        start = self.first_child[node]
+        end = start + self.num_children[node]
+        visits = self.visits[start:end]
+        unvisited = np.flatnonzero(visits == 0)
+        if len(unvisited):
+            return start + int(unvisited[-1])
+        weights = self.rewards[start:end] / visits + c_param * np.sqrt(2 * math.log(self.visits[node]) / visits)
+        return start + int(np.argmax(weights))
+
+    # Descend from the root applying actions to the scratch state, stopping at the first
+    # unvisited child or at a terminal node. Returns the path of node indices
+    def tree_policy(self):
+        node = 0
+        path = [0]
+        while True:
+            if not self.expanded[node]:
+                self._expand(node)
+            if self.num_children[node] == 0:
+                return path
+            child = self.best_child(node)
+            self.state.apply(self.actions[self.action_codes[child]])
+            path.append(child)
+            if self.visits[child] == 0:
+                return path
+            node = child
+
+    # Play random actions on the scratch state, score it, then undo them
+    def rollout(self):
+        depth = 0
+        action = self.policy(self.state)
+        while action is not None:
+            self.state.apply(action)
+            depth += 1
+            action = self.policy(self.state)
+        reward = MCTSNode.evaluate_state(self.state)
+        for _ in range(depth):
+            self.state.undo()
+        return reward
+
+    def backpropagate(self, path, reward):
+        nodes = np.array(path)
+        self.visits[nodes] += 1
+        self.rewards[nodes] += reward
+        # Return the scratch state to the root
+        for _ in range(len(path) - 1):
+            self.state.undo()
+
+    def search(self, iterations=1000, rollouts_per_leaf=1, stats=None, time_limit=None, early_stop=False):
+        budget = SearchBudget(iterations, time_limit, early_stop, self.root_visits)
+        while budget.take():
+            path = self.tree_policy()
+            reward = sum(self.rollout() for _ in range(rollouts_per_leaf)) / rollouts_per_leaf
+            self.backpropagate(path, reward)
+            record_depth(stats, len(path) - 1)
+        budget.report(stats)
+        self.report(stats)
+
+    # Add the node count and the bytes held by the node arrays to a stats dict. Nodes are never
+    # dropped, so the count at the end of a search is its peak
+    def report(self, stats):
+        node_bytes = sum(getattr(self, name).nbytes for name in ('visits', 'rewards', 'parents', 'first_child', 'num_children', 'action_codes', 'expanded'))
+        report_peak(stats, self.size, node_bytes)
+
+    # Visit counts of the root's children
+    def root_visits(self):
+        start = self.first_child[0]
+        return self.visits[start:start + self.num_children[0]].tolist()
+
+    # The root action whose child has the best mean reward, or with by_visits the most visits
+    def best_action(self, by_visits=False):
+        start = self.first_child[0]
+        end = start + self.num_children[0]
+        visits = self.visits[start:end]
+        if by_visits:
+            return self.actions[self.action_codes[start + int(np.argmax(visits))]]
+        means = np.where(visits > 0, self.rewards[start:end] / np.maximum(visits, 1), -np.inf)
+        return self.actions[self.action_codes[start + int(np.argmax(means))]]
+
+# Run a transposition-table search and return its root node
+def transposition_search(root_state, iterations=1000, max_table_size=100000, root_node=None, rollouts_per_leaf=1, stats=None, time_limit=None, early_stop=False, rollout_policy=random_policy):
+    if isinstance(root_node, TranspositionNode) and root_node.state is not None and root_node.state == root_state:
+        table = root_node.table
+    else:
+        table = TranspositionTable(max_table_size, rollout_policy)
+        root_node = table.lookup(root_state)
+    table.peak = len(table.nodes)
+    if iterations is not None:
+        iterations = max(iterations - root_node.visits, 1)
+    budget = SearchBudget(iterations, time_limit, early_stop, lambda: [edge[0] for edge in root_node.edges.values()])
+    while budget.take():
+        # Select a path of (node, edge) pairs down to a new or terminal node
+        table.release()
+        node = root_node
+        path = []
+        while True:
+            table.touch(node)
+            if node.untried():
+                action = node.untried_actions.pop()
+                child = table.lookup(node.state.perform_action(action))
+                edge = node.edges[action] = [0, child]
+                path.append(edge)
+                node = child
+                break
+            if node.is_terminal():
+                break
+            action, edge = node.best_edge()
+            if edge[1].state is None:
+                edge[1] = table.lookup(node.state.perform_action(action))
+            path.append(edge)
+            node = edge[1]
+        reward = node.rollout_batch(rollouts_per_leaf)
+        # Back the reward up the path, updating the shared nodes and the edges taken
+        root_node.visits += 1
+        root_node.reward += reward
+        for edge in path:
+            edge[0] += 1
+            edge[1].visits += 1
+            edge[1].reward += reward
+        record_depth(stats, len(path))
+    budget.report(stats)
+    report_peak(stats, table.peak, table.peak * estimate_node_bytes(root_node))
+    return root_node
+
+# Count a selection that went depth levels below the root, when a stats dict is being collected
+def record_depth(stats, depth):
+    if stats is not None:
+        depth_counts = stats.setdefault('depth_counts', {})
+        depth_counts[depth] = depth_counts.get(depth, 0) + 1
+
+# Add the most nodes a search held at once, and their size in bytes, to a stats dict
+def report_peak(stats, nodes, node_bytes):
+    if stats is not None:
+        stats['peak_nodes'] = max(stats.get('peak_nodes', 0), nodes)
+        stats['peak_node_bytes'] = max(stats.get('peak_node_bytes', 0), node_bytes)
+
+# Decides when a search stops: after iterations (None for no limit), at a wall-clock deadline
+# time_limit seconds away, or with early_stop, once the most visited root child is further
+# ahead of the runner-up than the iterations still left could make up. root_visits returns
+# the visit counts of the root's children and is only called every check_interval iterations
+class SearchBudget:
+    def __init__(self, iterations=1000, time_limit=None, early_stop=False, root_visits=None, check_interval=16):
+        if iterations is None and time_limit is None:
+            raise ValueError("A search needs an iteration count, a time limit or both")
+        self.remaining = math.inf if iterations is None else iterations
+        self.start_time = time.perf_counter()
+        self.deadline = None if time_limit is None else self.start_time + time_limit
+        self.early_stop = early_stop
+        self.root_visits = root_visits
+        self.check_interval = check_interval
+        self.completed = 0
+
+    # Claim the next iteration, or return False once the budget is spent. The first is always granted
+    def take(self):
+        if self.remaining <= 0:
+            return False
+        if self.completed and self._should_stop():
+            self.remaining = 0
+            return False
+        self.remaining -= 1
+        self.completed += 1
+        return True
+
+    def _should_stop(self):
+        remaining = self.remaining
+        if self.deadline is not None:
+            now = time.perf_counter()
+            if now >= self.deadline:
+                return True
+            # The iterations the deadline still allows, at the rate reached so far
+            remaining = min(remaining, self.completed * (self.deadline - now) / (now - self.start_time))
+        if self.early_stop and self.completed % self.check_interval == 0:
+            visits = sorted(self.root_visits(), reverse=True) + [0, 0]
+            return visits[0] - visits[1] > remaining
+        return False
+
+    # Add the iterations run and the seconds taken to a stats dict, if one is being collected
+    def report(self, stats):
+        if stats is not None:
+            stats['iterations'] = stats.get('iterations', 0) + self.completed
+            stats['seconds'] = stats.get('seconds', 0.0) + time.perf_counter() - self.start_time
+
+# Every node in the subtree under node, parents before children
+def subtree_nodes(node):
+    nodes = [node]
+    for current in nodes:
+        nodes.extend(current.children)
+    return nodes
+
+# Rough size in bytes of a node and its State: the objects themselves and the containers they
+# hold, one level deep. Used to turn a byte cap into a node cap
+def estimate_node_bytes(node):
+    size = sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.state) + sys.getsizeof(node.state.__dict__)
+    for value in node.state.__dict__.values():
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(sys.getsizeof(item) for item in value.values())
+    return size
+
+# Keeps a search tree to at most max_nodes nodes. When a new node takes it up to the cap, the
+# least visited subtrees are collapsed into their parents until the tree is down to shrink_to
+# of the cap. Any subtree can go except the root's best and most visited children themselves,
+# so the cap holds even when the root has more actions than max_nodes, and each collapse frees
+# room for the next quarter of the cap's additions. A collapsed subtree's action goes back on
+# its parent's untried list, its visits and reward stay in the parent's totals, which already
+# include them, and its nodes are cleared so their States are freed at once. Also tracks the
+# peak node count
+class NodeLimit:
+    def __init__(self, root_node, max_nodes=None, shrink_to=0.75):
+        self.max_nodes = max_nodes
+        self.shrink_to = shrink_to
+        self.nodes = len(subtree_nodes(root_node))
+        self.peak = self.nodes
+        self.collapsed = 0
+
+    def node_added(self, root_node):
+        self.nodes += 1
+        self.peak = max(self.peak, self.nodes)
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            self.collapse(root_node)
+
+    def collapse(self, root_node):
+        nodes = subtree_nodes(root_node)
+        sizes = {}
+        for node in reversed(nodes):
+            sizes[node] = 1 + sum(sizes[child] for child in node.children)
+        target = int(self.max_nodes * self.shrink_to)
+        count = len(nodes)
+        # The move mcts() returns comes from these, so they stay whatever their visits
+        kept = {root_node}
+        if root_node.children:
+            kept.add(root_node.best_child(c_param=0))
+            kept.add(max(root_node.children, key=lambda child: child.visits))
+        candidates = sorted((node for node in nodes if node not in kept), key=lambda node: node.visits)
+        for node in candidates:
+            if count <= target:
+                break
+            if node.parent is None:
+                continue  # Already dropped with an ancestor
+            parent = node.parent
+            parent.children.remove(node)
+            parent.untried_actions.insert(0, node.action)
+            for removed in subtree_nodes(node):
+                removed.state = None
+                removed.parent = None
+                removed.children = []
+                removed.untried_actions = []
+                removed.action_iterator = None
+            count -= sizes[node]
+            self.collapsed += sizes[node]
+        self.nodes = count
+
+    # Add the peak node count, its estimated size and the nodes collapsed to a stats dict
+    def report(self, stats, root_node):
+        report_peak(stats, self.peak, self.peak * estimate_node_bytes(root_node))
+        if stats is not None:
+            stats['collapsed_nodes'] = stats.get('collapsed_nodes', 0) + self.collapsed
+
+    # Count the tree again after a search that added nodes without calling node_added, as the
+    # tree-parallel one does. Nothing is collapsed there, so the tree is at its largest once
+    # the search ends
+    def recount(self, root_node):
+        self.nodes = len(subtree_nodes(root_node))
+        self.peak = max(self.peak, self.nodes)
+
+# Add the best rollout reward found to a stats dict, if one is being collected with pruning on
+def report_incumbent(stats, incumbent):
+    if stats is not None and incumbent is not None:
+        stats['incumbent'] = max(stats.get('incumbent', -math.inf), incumbent.value)
+
+# Run a plain tree search and return its root node. With threads > 1 the iterations are
+# shared by a thread pool working on the one tree, using virtual loss to spread the threads
+# out; this scales on free-threaded CPython, or wherever rollouts release the GIL
+def tree_search(root_state, iterations=1000, root_node=None, threads=1, virtual_loss=1, rollouts_per_leaf=1, stats=None, time_limit=None, early_stop=False, rollout_policy=random_policy, widening=None, pruning=False, rave=None, max_nodes=None):
+    if isinstance(root_node, MCTSNode) and not isinstance(root_node, TranspositionNode) and root_node.state == root_state:
+        root_node.parent = None  # Detach from the old tree so it can be freed
+    else:
+        root_node = MCTSNode(root_state, rollout_policy=rollout_policy, widening=widening, rave=rave)
+    if iterations is not None:
+        iterations = max(iterations - root_node.visits, 1)
+    budget = SearchBudget(iterations, time_limit, early_stop, lambda: [child.visits for child in list(root_node.children)])
+    # The incumbent is kept for this call only: one found under a sibling of a reused root is out of reach
+    incumbent = Incumbent() if pruning else None
+    limit = NodeLimit(root_node, max_nodes)
+    if threads <= 1:
+        while budget.take():
+            path = root_node.select_path(incumbent=incumbent)
+            played = [] if rave is not None else None
+            reward = path[-1].rollout_batch(rollouts_per_leaf, incumbent, played)
+            MCTSNode.backpropagate_path(path, reward, played=played)
+            record_depth(stats, len(path) - 1)
+            if len(path) > 1 and path[-1].visits == 1:
+                limit.node_added(root_node)
+        budget.report(stats)
+        report_incumbent(stats, incumbent)
+        limit.report(stats, root_node)
+        return root_node
+
+    remaining_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with remaining_lock:
+                if not budget.take():
+                    return
+            path = root_node.select_path(virtual_loss, incumbent)
+            played = [] if rave is not None else None
+            reward = path[-1].rollout_batch(rollouts_per_leaf, incumbent, played)
+            MCTSNode.backpropagate_path(path, reward, virtual_loss, played)
+            with remaining_lock:
+                record_depth(stats, len(path) - 1)
+
+    with ThreadPoolExecutor(threads) as pool:
+        for future in [pool.submit(worker) for _ in range(threads)]:
+            future.result()
+    budget.report(stats)
+    report_incumbent(stats, incumbent)
+    limit.recount(root_node)
+    limit.report(stats, root_node)
+    return root_node
+
+# (action, visits, total reward) for each explored action at the root of a finished search
+def root_action_statistics(root_node):
+    if isinstance(root_node, TranspositionNode):
+        return [(action, child.visits, child.reward) for action, (_, child) in root_node.edges.items() if child.visits]
+    return [(child.action, child.visits, child.reward) for child in root_node.children]
+
+# One root-parallel worker: an independent search with its own seed, reporting only root
+# statistics and its stats dict
+def _root_parallel_worker(root_state, iterations, seed, transpositions, max_table_size, rollouts_per_leaf, time_limit=None, early_stop=False, rollout_policy=random_policy, widening=None, pruning=False, rave=None, max_nodes=None):
+    random.seed(seed)
+    stats = {}
+    if transpositions:
+        root_node = transposition_search(root_state, iterations, max_table_size, rollouts_per_leaf=rollouts_per_leaf, stats=stats, time_limit=time_limit, early_stop=early_stop, rollout_policy=rollout_policy)
+    else:
+        root_node = tree_search(root_state, iterations, rollouts_per_leaf=rollouts_per_leaf, stats=stats, time_limit=time_limit, early_stop=early_stop, rollout_policy=rollout_policy, widening=widening, pruning=pruning, rave=rave, max_nodes=max_nodes)
+    return root_action_statistics(root_node), stats
+
+# Add the stats dicts of root-parallel workers, which all ran at the same time, to a stats
+# dict. Iterations, depth counts and collapsed nodes are added up, and so are the peak node
+# counts and sizes, since every worker's tree was in memory at once. The seconds taken are
+# the slowest worker's and the incumbent is the best any worker found
+def report_worker_stats(stats, worker_stats):
+    if stats is None:
+        return
+    depth_counts = stats.setdefault('depth_counts', {})
+    for one_stats in worker_stats:
+        for depth, count in one_stats.get('depth_counts', {}).items():
+            depth_counts[depth] = depth_counts.get(depth, 0) + count
+    stats['iterations'] = stats.get('iterations', 0) + sum(one_stats.get('iterations', 0) for one_stats in worker_stats)
+    stats['seconds'] = stats.get('seconds', 0.0) + max((one_stats.get('seconds', 0.0) for one_stats in worker_stats), default=0.0)
+    report_peak(stats, sum(one_stats.get('peak_nodes', 0) for one_stats in worker_stats), sum(one_stats.get('peak_node_bytes', 0) for one_stats in worker_stats))
+    if any('collapsed_nodes' in one_stats for one_stats in worker_stats):
+        stats['collapsed_nodes'] = stats.get('collapsed_nodes', 0) + sum(one_stats.get('collapsed_nodes', 0) for one_stats in worker_stats)
+    incumbents = [one_stats['incumbent'] for one_stats in worker_stats if 'incumbent' in one_stats]
+    if incumbents:
+        stats['incumbent'] = max(stats.get('incumbent', -math.inf), max(incumbents))
+
+# Split the iterations across independent searches in worker processes, merge their root
+# statistics and return the action with the best mean reward, or with early_stop the most
+# visited one. The workers' stats are added to stats, if given, by report_worker_stats
+def root_parallel_mcts(root_state, iterations=1000, workers=2, executor=None, transpositions=False, max_table_size=100000, rollouts_per_leaf=1, stats=None, time_limit=None, early_stop=False, rollout_policy=random_policy, widening=None, pruning=False, rave=None, max_nodes=None):
+    iterations_per_worker = None if iterations is None else -(-iterations // workers)
+    seeds = [random.getrandbits(32) for _ in range(workers)]
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(workers)
+    try:
+        worker = partial(
+            _root_parallel_worker,
+            root_state,
+            iterations_per_worker,
+            transpositions=transpositions,
+            max_table_size=max_table_size,
+            rollouts_per_leaf=rollouts_per_leaf,
+            time_limit=time_limit,
+            early_stop=early_stop,
+            rollout_policy=rollout_policy,
+            widening=widening,
+            pruning=pruning,
+            rave=rave,
+            max_nodes=max_nodes,
+        )
+        results = list(executor.map(worker, seeds))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    report_worker_stats(stats, [worker_stats for _, worker_stats in results])
+    totals = {}
+    for statistics, _ in results:
+        for action, visits, reward in statistics:
+            total = totals.setdefault(action, [0, 0.0])
+            total[0] += visits
+            total[1] += reward
+    if early_stop:
+        # The workers stopped once their most visited action was settled, so that is the one to trust
+        action = max(totals, key=lambda a: totals[a][0])
+    else:
+        action = max(totals, key=lambda a: totals[a][1] / totals[a][0])
+    # Hand back the caller's own Box rather than the copy that came back from the worker
+    boxes = {box.id: box for box in root_state.boxes_to_place}
+    return (boxes[action[0].id],) + tuple(action[1:])
+
+# Search from root_state and return the best action. Passing back the node returned with
+# return_node=True continues from its statistics instead of starting a fresh tree; iterations
+# is then the number of visits the root should reach, so only the difference is searched.
+# With workers > 1 the search runs root-parallel in separate processes, on executor if one
+# is given, and there is no node to return. threads > 1 runs a tree-parallel search instead.
+# rollouts_per_leaf > 1 backs up the mean of that many rollouts from each selected leaf.
+# array_tree=True searches an ArrayTree, which keeps no per-node objects or States.
+# A stats dict, if given, is filled with 'depth_counts': {selection depth: iterations},
+# 'iterations' and 'seconds' by every search, root-parallel workers' included. time_limit
+# stops the search after that many seconds, with iterations=None to search until then;
+# early_stop ends it as soon as the most visited root child can no longer be overtaken within
+# the iterations or time left, and that child's action is returned rather than the one with
+# the best mean reward, which the stop rule does not settle. rollout_policy is a
+# name from rollout_policies or a callable taking a state and returning an action. widening,
+# a ProgressiveWidening, limits each node's children by its visits in the MCTSNode tree.
+# pruning=True, also only for the MCTSNode tree, tracks the best rollout found during the call:
+# rollouts stop once they cannot beat it and selection skips children whose upper bound is
+# below it. The stats dict then also gets its reward as 'incumbent'. rave, a Rave, turns on
+# RAVE selection and AMAF-ordered expansion, again only in the MCTSNode tree.
+# max_nodes caps the MCTSNode tree of a serial search by collapsing low-visit subtrees (see
+# NodeLimit); max_bytes caps its estimated size the same way, converted to a node count from
+# the root's size. Peak memory is only reported into a stats dict, so nothing is measured
+# without one: every search adds 'peak_nodes' and 'peak_node_bytes' (estimated, except for
+# the array_tree's arrays), summed over root-parallel workers, an MCTSNode tree also adds
+# 'collapsed_nodes', and 'peak_traced_bytes' covers the whole call only if the caller has
+# started tracemalloc; mcts() does not turn it on
+def mcts(root_state, iterations=1000, transpositions=False, max_table_size=100000, root_node=None, return_node=False, workers=1, executor=None, threads=1, virtual_loss=1, rollouts_per_leaf=1, array_tree=False, stats=None, time_limit=None, early_stop=False, rollout_policy='random', widening=None, pruning=False, rave=None, max_nodes=None, max_bytes=None):
+    rollout_policy = get_rollout_policy(rollout_policy)
+    if threads > 1 and (transpositions or array_tree):
+        raise ValueError("Tree-parallel search (threads > 1) only supports the MCTSNode tree")
+    if array_tree and transpositions:
+        raise ValueError("array_tree does not support transpositions")
+    if widening is not None and (transpositions or array_tree):
+        raise ValueError("Progressive widening only supports the MCTSNode tree")
+    if pruning and (transpositions or array_tree):
+        raise ValueError("Upper-bound pruning only supports the MCTSNode tree")
+    if rave is not None and (transpositions or array_tree):
+        raise ValueError("RAVE only supports the MCTSNode tree")
+    if (max_nodes is not None or max_bytes is not None) and (transpositions or array_tree):
+        raise ValueError("max_nodes and max_bytes only apply to the MCTSNode tree; the transposition table has max_table_size")
+    if (max_nodes is not None or max_bytes is not None) and threads > 1:
+        raise ValueError("max_nodes and max_bytes cannot collapse subtrees under a tree-parallel search (threads > 1)")
+    if max_bytes is not None:
+        node_cap = max(max_bytes // estimate_node_bytes(MCTSNode(root_state)), 1)
+        max_nodes = node_cap if max_nodes is None else min(max_nodes, node_cap)
+    if max_nodes is not None and max_nodes < 4:
+        raise ValueError("max_nodes and max_bytes must leave room for 4 nodes: the root, its best and most visited children and a new node")
+    if stats is not None and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    action, best_node = _search(
+        root_state,
+        iterations=iterations,
+        transpositions=transpositions,
+        max_table_size=max_table_size,
+        root_node=root_node,
+        workers=workers,
+        executor=executor,
+        threads=threads,
+        virtual_loss=virtual_loss,
+        rollouts_per_leaf=rollouts_per_leaf,
+        array_tree=array_tree,
+        stats=stats,
+        time_limit=time_limit,
+        early_stop=early_stop,
+        rollout_policy=rollout_policy,
+        widening=widening,
+        pruning=pruning,
+        rave=rave,
+        max_nodes=max_nodes,
+    )
+    if stats is not None and tracemalloc.is_tracing():
+        stats['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+    if return_node:
+        return action, best_node
+    return action
+
+# The body of mcts() once its arguments are checked: run the chosen search and return the
+# action together with the node it leads to, or None for the searches that keep no nodes
+def _search(root_state, *, iterations, transpositions, max_table_size, root_node, workers, executor, threads, virtual_loss, rollouts_per_leaf, array_tree, stats, time_limit, early_stop, rollout_policy, widening, pruning, rave, max_nodes):
+    if workers > 1:
+        action = root_parallel_mcts(
+            root_state,
+            iterations=iterations,
+            workers=workers,
+            executor=executor,
+            transpositions=transpositions,
+            max_table_size=max_table_size,
+            rollouts_per_leaf=rollouts_per_leaf,
+            stats=stats,
+            time_limit=time_limit,
+            early_stop=early_stop,
+            rollout_policy=rollout_policy,
+            widening=widening,
+            pruning=pruning,
+            rave=rave,
+            max_nodes=max_nodes,
+        )
+        return action, None
+    if array_tree:
+        tree = ArrayTree(root_state, rollout_policy=rollout_policy)
+        tree.search(iterations, rollouts_per_leaf=rollouts_per_leaf, stats=stats, time_limit=time_limit, early_stop=early_stop)
+        action = tree.best_action(by_visits=early_stop)
+        return action, None
+    if transpositions:
+        # Share statistics between placement orders that reach the same state
+        root_node = transposition_search(
+            root_state,
+            iterations=iterations,
+            max_table_size=max_table_size,
+            root_node=root_node,
+            rollouts_per_leaf=rollouts_per_leaf,
+            stats=stats,
+            time_limit=time_limit,
+            early_stop=early_stop,
+            rollout_policy=rollout_policy,
+        )
+        if early_stop:
+            action, edge = max(root_node.edges.items(), key=lambda item: item[1][0])
+        else:
+            action, edge = root_node.best_edge(c_param=0)
+        best_node = edge[1]
+    else:
+        root_node = tree_search(
+            root_state,
+            iterations=iterations,
+            root_node=root_node,
+            threads=threads,
+            virtual_loss=virtual_loss,
+            rollouts_per_leaf=rollouts_per_leaf,
+            stats=stats,
+            time_limit=time_limit,
+            early_stop=early_stop,
+            rollout_policy=rollout_policy,
+            widening=widening,
+            pruning=pruning,
+            rave=rave,
+            max_nodes=max_nodes,
+        )
+        # Select the action corresponding to the best child. Under RAVE that is the most
+        # visited one: selection already went by the blended values, and a child that was
+        # only tried a few times can have a lucky mean. With early_stop it is the most visited
+        # one too, since that is the choice the search stopped on
+        if rave is None and not early_stop:
+            best_node = root_node.best_child(c_param=0)
+        else:
+            best_node = max(root_node.children, key=lambda child: child.visits)
+        action = best_node.action
+    return action, best_node
@@ -1,5 +1,6 @@
 import random
 import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Tuple
 
 from state import State, Box
@@ -99,7 +100,20 @@ def plot_state_3d(state: State, title: str, save_filename=None):
     else:
         plt.show()
 
-def mcts_packing_with_timing_and_reward(boxes: List[Box], width: int, height: int, depth: int, iterations_per_move: int = 1000) -> Tuple[State, List[float], List[float], List[np.ndarray]]:
+# Roughly how many more boxes will fit: the remaining boxes, scaled down by how much of
+# their total volume the free volume of the container could hold
+def estimate_moves_left(state: State) -> int:
+    free_volume = state.width * state.height * state.depth - sum(box.width * box.height * box.depth for box, _, _ in state.action_history)
+    box_volume = sum(box.width * box.height * box.depth for box in state.boxes_to_place)
+    n_boxes = len(state.boxes_to_place)
+    return max(1, min(n_boxes, round(n_boxes * free_volume / max(box_volume, 1))))
+
+# With time_budget set, the packing as a whole gets that many seconds: each move is given
+# twice its even share of the time left and stops early once its choice is settled, so the
+# time easy moves leave unused goes to the moves after them. iterations_per_move still caps
+# each move unless it is None. rollout_policy, widening, pruning, rave, max_nodes and
+# max_bytes are passed on to mcts()
+def mcts_packing_with_timing_and_reward(boxes: List[Box], width: int, height: int, depth: int, iterations_per_move: int = 1000, reuse_tree: bool = True, workers: int = 1, time_budget: float = None, rollout_policy='random', widening=None, pruning=False, rave=None, max_nodes=None, max_bytes=None) -> Tuple[State, List[float], List[float], List[np.ndarray]]:
     state = State(width, height, depth)
     for box in boxes:
         state.add_box(box)
@@ -107,10 +121,20 @@ def mcts_packing_with_timing_and_reward(boxes: List[Box], width: int, height: in
     time_costs = []
     rewards = []
     feature_vectors = []
+    root_node = None
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    # With more than one worker each move is searched root-parallel, on one pool kept for the whole packing
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
     
     while state.boxes_to_place and state.get_possible_actions():
         start_time = time.time()
-        best_action = mcts(state, iterations=iterations_per_move)
+        time_limit = None
+        if deadline is not None:
+            time_limit = max(deadline - time.perf_counter(), 0) * 2 / (estimate_moves_left(state) + 1)
+        # Continue from the subtree under the previous move rather than a fresh tree
+        best_action, root_node = mcts(state, iterations=iterations_per_move, root_node=root_node, return_node=True, workers=workers, executor=executor, time_limit=time_limit, early_stop=deadline is not None, rollout_policy=rollout_policy, widening=widening, pruning=pruning, rave=rave, max_nodes=max_nodes, max_bytes=max_bytes)
+        if not reuse_tree:
+            root_node = None
         end_time = time.time()
         elapsed_time = end_time - start_time
         time_costs.append(elapsed_time)
@@ -128,6 +152,8 @@ def mcts_packing_with_timing_and_reward(boxes: List[Box], width: int, height: in
             print("No valid actions available. Terminating packing.")
             break
     
+    if executor is not None:
+        executor.shutdown()
     return state, time_costs, rewards, feature_vectors
 
 def plot_time_cost(time_costs: List[float]):
@@ -1,20 +1,164 @@
+import random
 from typing import List, Tuple
 from itertools import permutations
 
 # Define the penalty factor globally
 penalty_factor = 10  # Adjust this value as needed
 
-# Box class representing a 3D box to be packed
+# Proposals sample_action rejects before falling back to enumerating every legal action
+sample_attempts = 8
+
+# Once a state has index_threshold free spaces they are also bucketed on a grid of index_cells
+# cells per axis, so placements find the spaces they touch without scanning every space. With
+# fewer spaces the scan is cheaper than keeping the grid up to date
+index_threshold = 64
+index_cells = 8
+
+# Zobrist keys: a 64-bit key per state feature, given as a tuple of integers (and nested tuples
+# of them) whose first item is one of the feature tags below. Hashes of integer tuples are not
+# salted per process the way string hashes are, so scrambling the tuple hash with the splitmix64
+# finaliser gives a feature the same key in every process and run, and no key is stored
+space_feature = 0  # (space_feature, space): a free space
+boxes_feature = 1  # (boxes_feature, shape, count): count boxes of a shape left
+_mask = (1 << 64) - 1
+
+def zobrist_key(feature):
+    key = (hash(feature) + 0x9E3779B97F4A7C15) & _mask
+    key = ((key ^ (key >> 30)) * 0xBF58476D1CE4E5B9) & _mask
+    key = ((key ^ (key >> 27)) * 0x94D049BB133111EB) & _mask
+    return key ^ (key >> 31)
+
+# Volume of a space given as (min corner, max corner)
+def space_volume(space):
+    (x0, y0, z0), (x1, y1, z1) = space
+    return (x1 - x0) * (y1 - y0) * (z1 - z0)
+
+# The side lengths of a space, shortest first
+def sorted_sides(space):
+    (x0, y0, z0), (x1, y1, z1) = space
+    return tuple(sorted((x1 - x0, y1 - y0, z1 - z0)))
+
+# True if two regions, each given as (min corner, max corner), share some volume
+def regions_overlap(a, b):
+    (ax0, ay0, az0), (ax1, ay1, az1) = a
+    (bx0, by0, bz0), (bx1, by1, bz1) = b
+    return ax0 < bx1 and bx0 < ax1 and ay0 < by1 and by0 < ay1 and az0 < bz1 and bz0 < az1
+
+# True if any of spaces contains region
+def any_contains(spaces, region):
+    (x0, y0, z0), (x1, y1, z1) = region
+    for (a0, b0, c0), (a1, b1, c1) in spaces:
+        if a0 <= x0 and b0 <= y0 and c0 <= z0 and x1 <= a1 and y1 <= b1 and z1 <= c1:
+            return True
+    return False
+
+# Free spaces bucketed by the grid cells they overlap, so the spaces meeting a region are
+# looked up from the few cells it covers
+class SpaceGrid:
+    def __init__(self, width, height, depth, spaces=()):
+        self.cells_per_axis = index_cells
+        self.cell_sizes = (-(-width // index_cells), -(-height // index_cells), -(-depth // index_cells))
+        self.cells = {}
+        for space in spaces:
+            self.add(space)
+
+    def copy(self):
+        grid = SpaceGrid.__new__(SpaceGrid)
+        grid.cells_per_axis = self.cells_per_axis
+        grid.cell_sizes = self.cell_sizes
+        grid.cells = {cell: spaces.copy() for cell, spaces in self.cells.items()}
+        return grid
+
+    # Ids of the cells a region overlaps
+    def cells_of(self, region):
+        (x0, y0, z0), (x1, y1, z1) = region
+        cx, cy, cz = self.cell_sizes
+        n = self.cells_per_axis
+        zs = range(z0 // cz, (z1 - 1) // cz + 1)
+        return [(i * n + j) * n + k for i in range(x0 // cx, (x1 - 1) // cx + 1) for j in range(y0 // cy, (y1 - 1) // cy + 1) for k in zs]
+
+    def add(self, space):
+        for cell in self.cells_of(space):
+            spaces = self.cells.get(cell)
+            if spaces is None:
+                spaces = self.cells[cell] = set()
+            spaces.add(space)
+
+    def remove(self, space):
+        for cell in self.cells_of(space):
+            self.cells[cell].discard(space)
+
+    # The spaces sharing some volume with region
+    def overlapping(self, region):
+        found = set()
+        for cell in self.cells_of(region):
+            spaces = self.cells.get(cell)
+            if spaces:
+                found.update(spaces)
+        return [space for space in found if regions_overlap(space, region)]
+
+    # True if some space contains region. Any that does covers the cell of its minimum corner
+    def any_containing(self, region):
+        x, y, z = region[0]
+        cx, cy, cz = self.cell_sizes
+        n = self.cells_per_axis
+        return any_contains(self.cells.get(((x // cx) * n + y // cy) * n + z // cz, ()), region)
+
+# Orientation masks a box can be given: bit i allows the i-th permutation of (width, height,
+# depth) in itertools.permutations order. z is the vertical axis, so 'this_side_up' keeps the
+# depth on it and only turns the box about it
+orientation_masks = {
+    'any': 0b111111,
+    'this_side_up': 0b000101,  # (width, height, depth) and (height, width, depth)
+    'none': 0b000001,  # (width, height, depth) only
+}
+
+# Rotation tables shared by every box with the same dimensions and orientation mask
+_rotation_tables = {}
+
+# The distinct rotations of dimensions that mask allows, in permutation order. Each table is
+# built once and shared, so it must not be modified
+def rotation_table(dimensions, mask=orientation_masks['any']):
+    key = (dimensions, mask)
+    table = _rotation_tables.get(key)
+    if table is None:
+        rotations = []
+        for i, rotation in enumerate(permutations(dimensions)):
+            if mask >> i & 1 and rotation not in rotations:
+                rotations.append(rotation)
+        table = _rotation_tables[key] = tuple(rotations)
+    return table
+
+# Box class representing a 3D box to be packed. orientations is a name from orientation_masks
+# or a mask of the rotations the box may be placed in
 class Box:
-    def __init__(self, width: int, height: int, depth: int, box_id: int):
+    def __init__(self, width: int, height: int, depth: int, box_id: int, orientations='any'):
+        if isinstance(orientations, str):
+            if orientations not in orientation_masks:
+                raise ValueError(f"Unknown orientations {orientations!r}, expected one of {sorted(orientation_masks)} or a mask")
+            orientations = orientation_masks[orientations]
+        if not 0 < orientations <= orientation_masks['any']:
+            raise ValueError("An orientation mask must allow at least one of the six rotations")
         self.width = width
         self.height = height
         self.depth = depth
         self.id = box_id
+        self.orientations = orientations
+        self.rotations = rotation_table((width, height, depth), orientations)
+        # Boxes are interchangeable when they have the same dimensions and, if any rotations
+        # are ruled out, the same allowed rotations
+        self.shape = tuple(sorted((width, height, depth)))
+        if len(self.rotations) < len(rotation_table(self.shape)):
+            self.shape += (tuple(sorted(self.rotations)),)
 
-    # Returns possible rotations (all unique permutations of dimensions)
+    # Returns the allowed rotations, each distinct permutation of the dimensions once
     def get_rotations(self):
-        return list(set(permutations((self.width, self.height, self.depth))))
+        return self.rotations
+
+    # Returns the shape used to recognise interchangeable boxes: the sorted dimensions, followed
+    # by the allowed rotations for a box that cannot take every one
+    def get_shape(self):
+        return self.shape
 
     # Define equality comparison for Box based on id
     def __eq__(self, other):
@@ -41,34 +185,300 @@ class State:
         self.depth = depth
         self.boxes_to_place = boxes_to_place.copy()
         self.action_history = action_history.copy()  # Keeps track of placed boxes
-        self.available_spaces = available_spaces.copy()  # List of available spaces (each space is defined by min and max coordinates)
+        self.available_spaces = set(available_spaces)  # Set of available spaces (each space is defined by min and max coordinates)
+        self._spaces_at = {}  # The available spaces starting at each position, largest first (see _add_at)
+        self._space_sides = {}  # Number of available spaces with each sorted (shortest first) set of side lengths
+        self._largest_at = {}  # The largest first, second and third sorted sides of the spaces at each position
+        for space in self.available_spaces:
+            self._index_space(space)
+        self._room_sides = None  # The sorted sides that last showed _room_left() there was room
+        self._grid = None  # SpaceGrid over the available spaces, built by _space_grid() once there are enough
+        self._undo_stack = []  # Deltas recorded by apply() so placements can be undone in place
+        # Zobrist hash of the available spaces and the remaining box counts, kept up to date incrementally
+        self._hash = 0
+        for space in self.available_spaces:
+            self._hash ^= zobrist_key((space_feature, space))
+        self.box_counts = {}  # Number of remaining boxes of each shape
+        self._short_sides = {}  # Number of remaining boxes by their shortest side
+        self.remaining_volume = 0  # Volume of the remaining boxes, kept up to date by _count_box
+        for box in self.boxes_to_place:
+            self._count_box(box.get_shape(), 1)
+        self.placed_volume = sum(box.width * box.height * box.depth for box, _, _ in self.action_history)
+        self.free_volume = sum(space_volume(space) for space in self.available_spaces)  # Counting overlaps, kept up to date as spaces are added and removed
+        # Volume of the spaces too thin for the smallest side it was worked out for, kept up to
+        # date by split(); None until dead_volume() first works it out
+        self._dead_side = None
+        self._dead_volume = 0
 
     # Clone the state (deepcopy)
     def clone(self):
-        return State(
+        state = State(
             self.width,
             self.height,
             self.depth,
             self.boxes_to_place.copy(),
             self.action_history.copy(),
-            self.available_spaces.copy()
+            self.available_spaces
         )
+        if self._grid is not None:
+            state._grid = self._grid.copy()
+        state._dead_side = self._dead_side
+        state._dead_volume = self._dead_volume
+        return state
 
     def add_box(self, box: Box):
         self.boxes_to_place.append(box)
+        self._count_box(box.get_shape(), 1)
+
+    # Remove a box that will not be placed
+    def remove_box(self, box: Box):
+        self.boxes_to_place.remove(box)
+        self._count_box(box.get_shape(), -1)
+
+    # Change the remaining count of a shape, updating its Zobrist key
+    def _count_box(self, shape, change):
+        self.remaining_volume += change * shape[0] * shape[1] * shape[2]
+        side_count = self._short_sides.get(shape[0], 0) + change
+        if side_count:
+            self._short_sides[shape[0]] = side_count
+        else:
+            del self._short_sides[shape[0]]
+        count = self.box_counts.get(shape, 0)
+        if count:
+            self._hash ^= zobrist_key((boxes_feature, shape, count))
+        count += change
+        if count:
+            self._hash ^= zobrist_key((boxes_feature, shape, count))
+            self.box_counts[shape] = count
+        else:
+            del self.box_counts[shape]
 
     # Get all possible actions (box, position, rotation) that can be performed
     def get_possible_actions(self):
-        actions = []
+        return list(self.iter_actions())
+
+    # Yield the same actions as get_possible_actions, one at a time, so a caller that only
+    # needs the first few never builds the rest. The state must not change while iterating.
+    # Interchangeable boxes give the same moves, so only the first box of each shape is used.
+    # Spaces can overlap and share a minimum corner, so each box is placed at the minimum
+    # corners of the spaces, once per position and rotation if any space there fits it. The
+    # spaces at a position are tried largest first, so the first is usually the one that fits
+    def iter_actions(self):
+        positions = [
+            (position, [(x1 - x0, y1 - y0, z1 - z0) for (x0, y0, z0), (x1, y1, z1) in spaces])
+            for position, spaces in self._spaces_at.items()
+        ]
+        for box in self._boxes_by_shape().values():
+            for rotation in box.get_rotations():
+                box_width, box_height, box_depth = rotation
+                for position, sizes in positions:
+                    for size_x, size_y, size_z in sizes:
+                        if box_width <= size_x and box_height <= size_y and box_depth <= size_z:
+                            yield (box, position, rotation)  # Possible actions
+                            break
+
+    # The first remaining box of each shape, keyed by shape
+    def _boxes_by_shape(self):
+        boxes = {}
         for box in self.boxes_to_place:
-            rotations = box.get_rotations()  # Get possible rotations
-            for rotation in rotations:
-                for space in self.available_spaces:
+            if box.shape not in boxes:
+                boxes[box.shape] = box
+        return boxes
+
+    # Every legal action, best first by a cheap prior: larger boxes first, then lower positions
+    # (by z, then y, then x)
+    def prioritised_actions(self):
+        return sorted(self.iter_actions(), key=lambda action: (-action[2][0] * action[2][1] * action[2][2], action[1][2], action[1][1], action[1][0]))
+
+    # Identify an action by what it does rather than which box it uses, so the same move made
+    # with interchangeable boxes, or in different orders, is recognised as one
+    @staticmethod
+    def action_key(action):
+        box, position, rotation = action
+        return (box.get_shape(), position, rotation)
+
+    # True if no box can be placed. No box fits unless some space is at least as large, side
+    # by side once both are sorted, as the smallest sides of the remaining shapes, which is
+    # checked first without listing any actions
+    def is_terminal(self):
+        return not self._room_left() or next(self.iter_actions(), None) is None
+
+    # False if no space could hold any remaining box in any orientation: none has sorted side
+    # lengths at least the smallest first, second and third sorted sides of the shapes left.
+    # Spaces are looked at by their distinct sorted sides, and the sides that answered the
+    # last call are tried first, so while a space like that is left no space is visited
+    def _room_left(self):
+        if not self.box_counts:
+            return False
+        side_0 = min(shape[0] for shape in self.box_counts)
+        side_1 = min(shape[1] for shape in self.box_counts)
+        side_2 = min(shape[2] for shape in self.box_counts)
+        sides = self._room_sides
+        if sides is not None and sides in self._space_sides and side_0 <= sides[0] and side_1 <= sides[1] and side_2 <= sides[2]:
+            return True
+        for sides in self._space_sides:
+            if side_0 <= sides[0] and side_1 <= sides[1] and side_2 <= sides[2]:
+                self._room_sides = sides
+                return True
+        return False
+
+    # Each remaining shape with the positions that might hold it, leaving out shapes with none.
+    # A position qualifies if the shape's sorted sides are at most the largest first, second
+    # and third sorted sides of the spaces there, which every position with a space large
+    # enough for the shape in some orientation does, so each legal action is at one of them.
+    # Positions with the same largest sides are grouped, so each shape is checked once a group
+    def _candidate_positions(self, boxes):
+        groups = {}
+        for position, largest in self._largest_at.items():
+            groups.setdefault(largest, []).append(position)
+        candidates = []
+        for shape, box in boxes.items():
+            side_0, side_1, side_2 = shape[0], shape[1], shape[2]
+            positions = []
+            for (a, b, c), group in groups.items():
+                if side_0 <= a and side_1 <= b and side_2 <= c:
+                    positions.extend(group)
+            if positions:
+                candidates.append((box, positions))
+        return candidates
+
+    # Pick a uniformly random legal action, or None if there is none. A (shape, rotation slot,
+    # position) triple is proposed uniformly and accepted if the slot holds a distinct rotation
+    # that fits some space at the position, so accepted actions are uniform over the legal
+    # actions and only the chosen one is built. If sample_attempts proposals fail, they are
+    # drawn again from the (shape, position) pairs of _candidate_positions, which contain every
+    # legal action and no position too small for the shape; with none the state is terminal.
+    # Both ways are uniform over the legal actions, so together they are too. Only when those
+    # proposals fail as well is every legal action enumerated
+    def sample_action(self, rng=random):
+        if not self.boxes_to_place or not self._room_left():
+            return None
+        boxes = self._boxes_by_shape()
+        shape_boxes = list(boxes.values())
+        positions = list(self._spaces_at)
+        for _ in range(sample_attempts):
+            box = shape_boxes[int(rng.random() * len(shape_boxes))]
+            rotations = box.get_rotations()
+            slot = int(rng.random() * 6)
+            if slot >= len(rotations):
+                continue
+            position = positions[int(rng.random() * len(positions))]
+            if self._first_fit_at(position, rotations[slot]) is not None:
+                return (box, position, rotations[slot])
+        candidates = self._candidate_positions(boxes)
+        total = sum(len(box_positions) for _, box_positions in candidates)
+        if not total:
+            return None
+        for _ in range(sample_attempts):
+            pick = int(rng.random() * total)
+            for box, box_positions in candidates:
+                if pick < len(box_positions):
+                    break
+                pick -= len(box_positions)
+            rotations = box.get_rotations()
+            slot = int(rng.random() * 6)
+            if slot < len(rotations) and self._first_fit_at(box_positions[pick], rotations[slot]) is not None:
+                return (box, box_positions[pick], rotations[slot])
+        actions = self.get_possible_actions()
+        return rng.choice(actions) if actions else None
+
+    # The largest-volume box that still fits, trying its rotations in order, in the lowest
+    # space it fits in (by z, then y, then x of the space's minimum corner)
+    def largest_first_action(self):
+        spaces = sorted(self.available_spaces, key=lambda space: (space[0][2], space[0][1], space[0][0]))
+        boxes = {}
+        for box in self.boxes_to_place:
+            boxes.setdefault(box.get_shape(), box)
+        for shape in sorted(boxes, key=lambda shape: shape[0] * shape[1] * shape[2], reverse=True):
+            for rotation in boxes[shape].get_rotations():
+                for space in spaces:
                     if self.can_place_item(space, rotation):
-                        # Place the box at the minimum coordinates of the space
-                        position = space[0]
-                        actions.append((box, position, rotation))  # Possible actions
-        return actions
+                        return (boxes[shape], space[0], rotation)
+        return None
+
+    # Bottom-left fill: the lowest space any box fits in (by z, then y, then x of its minimum
+    # corner), filled with the largest-volume box that fits there
+    def lowest_fit_action(self):
+        boxes = {}
+        for box in self.boxes_to_place:
+            boxes.setdefault(box.get_shape(), box)
+        boxes = sorted(boxes.values(), key=lambda box: box.width * box.height * box.depth, reverse=True)
+        for space in sorted(self.available_spaces, key=lambda space: (space[0][2], space[0][1], space[0][0])):
+            for box in boxes:
+                for rotation in box.get_rotations():
+                    if self.can_place_item(space, rotation):
+                        return (box, space[0], rotation)
+        return None
+
+    # Add an available space to the indexes by position and by sorted sides
+    def _index_space(self, space):
+        self._add_at(space)
+        sides = sorted_sides(space)
+        self._space_sides[sides] = self._space_sides.get(sides, 0) + 1
+        largest = self._largest_at.get(space[0])
+        if largest is not None:
+            sides = (max(largest[0], sides[0]), max(largest[1], sides[1]), max(largest[2], sides[2]))
+        self._largest_at[space[0]] = sides
+
+    # Add a space to the available spaces, their indexes, the hash and the free and dead volumes
+    def _insert_space(self, space):
+        self.available_spaces.add(space)
+        self._index_space(space)
+        if self._grid is not None:
+            self._grid.add(space)
+        self._hash ^= zobrist_key((space_feature, space))
+        self.free_volume += space_volume(space)
+        self._dead_volume += self._space_dead(space)
+
+    # Take an available space out again, undoing _insert_space
+    def _discard_space(self, space):
+        self.available_spaces.discard(space)
+        spaces = self._spaces_at[space[0]]
+        spaces.remove(space)
+        if spaces:
+            largest = [0, 0, 0]
+            for other in spaces:
+                a, b, c = sorted_sides(other)
+                largest = [max(largest[0], a), max(largest[1], b), max(largest[2], c)]
+            self._largest_at[space[0]] = tuple(largest)
+        else:
+            del self._spaces_at[space[0]]
+            del self._largest_at[space[0]]
+        sides = sorted_sides(space)
+        count = self._space_sides[sides] - 1
+        if count:
+            self._space_sides[sides] = count
+        else:
+            del self._space_sides[sides]
+        if self._grid is not None:
+            self._grid.remove(space)
+        self._hash ^= zobrist_key((space_feature, space))
+        self.free_volume -= space_volume(space)
+        self._dead_volume -= self._space_dead(space)
+
+    # Add a space to the spaces at its minimum corner, keeping them largest first and spaces of
+    # equal volume in coordinate order, so the order does not depend on how they were added
+    def _add_at(self, space):
+        spaces = self._spaces_at.setdefault(space[0], [])
+        key = (-space_volume(space), space)
+        index = len(spaces)
+        while index and (-space_volume(spaces[index - 1]), spaces[index - 1]) > key:
+            index -= 1
+        spaces.insert(index, space)
+
+    # The first space starting at position that fits rotation, or None
+    def _first_fit_at(self, position, rotation):
+        for space in self._spaces_at.get(position, ()):
+            if self.can_place_item(space, rotation):
+                return space
+        return None
+
+    # The grid over the available spaces, built once there are index_threshold of them, or
+    # None while there are fewer
+    def _space_grid(self):
+        if self._grid is None and len(self.available_spaces) >= index_threshold:
+            self._grid = SpaceGrid(self.width, self.height, self.depth, self.available_spaces)
+        return self._grid
 
     # Check if the box can be placed in the specified space with the given rotation
     def can_place_item(self, space, rotation):
@@ -81,76 +491,145 @@ class State:
             return True
         return False
 
-    # Split the space after placing the box
+    # Update the free spaces for a box placed at position. The spaces are empty maximal spaces
+    # (EMS) and may overlap, so every space the box intersects is replaced by up to six pieces:
+    # the parts of it on each side of the box, each spanning the space fully along the other
+    # two axes, except the part above the box, which only covers the box's top face. So every
+    # space starts on the floor or on top of a box, and any box placed in one is fully
+    # supported. space is the one the box was placed in. Returns the spaces removed and the
+    # spaces added
     def split(self, space, box, position, rotation):
-        (x0, y0, z0), (x1, y1, z1) = space
         box_width, box_height, box_depth = rotation
         px, py, pz = position
+        qx, qy, qz = px + box_width, py + box_height, pz + box_depth
+        region = (position, (qx, qy, qz))
 
-        # Remove the occupied space
-        self.available_spaces.remove(space)
+        grid = self._space_grid()
+        if grid is None:
+            intersected = [free_space for free_space in self.available_spaces if regions_overlap(free_space, region)]
+        else:
+            intersected = grid.overlapping(region)
 
-        # Calculate the remaining spaces after placing the box
         new_spaces = []
+        for free_space in intersected:
+            (x0, y0, z0), (x1, y1, z1) = free_space
+            # Remove the intersected space
+            self._discard_space(free_space)
+            # Left and right of the box
+            if x0 < px:
+                new_spaces.append(((x0, y0, z0), (px, y1, z1)))
+            if qx < x1:
+                new_spaces.append(((qx, y0, z0), (x1, y1, z1)))
+            # Behind and in front of the box
+            if y0 < py:
+                new_spaces.append(((x0, y0, z0), (x1, py, z1)))
+            if qy < y1:
+                new_spaces.append(((x0, qy, z0), (x1, y1, z1)))
+            # Below and above the box
+            if z0 < pz:
+                new_spaces.append(((x0, y0, z0), (x1, y1, pz)))
+            if qz < z1:
+                new_spaces.append(((max(x0, px), max(y0, py), qz), (min(x1, qx), min(y1, qy), z1)))
+        return intersected, self.merge_spaces(new_spaces)
 
-        # Right space
-        if px + box_width < x1:
-            new_space = ((px + box_width, y0, z0), (x1, y1, z1))
-            new_spaces.append(new_space)
-
-        # Front space
-        if py + box_height < y1:
-            new_space = ((px, py + box_height, z0), (px + box_width, y1, z1))
-            new_spaces.append(new_space)
-
-        # Top space
-        if pz + box_depth < z1:
-            new_space = ((px, py, pz + box_depth), (px + box_width, py + box_height, z1))
-            new_spaces.append(new_space)
-
-        # Left space
-        if x0 < px:
-            new_space = ((x0, y0, z0), (px, y1, z1))
-            new_spaces.append(new_space)
-
-        # Back space
-        if y0 < py:
-            new_space = ((px, y0, z0), (px + box_width, py, z1))
-            new_spaces.append(new_space)
-
-        # Bottom space
-        if z0 < pz:
-            new_space = ((px, py, z0), (px + box_width, py + box_height, pz))
-            new_spaces.append(new_space)
-
-        # Add the new spaces to the available_spaces list
-        self.available_spaces.extend(new_spaces)
+    # Add the new spaces from a split, leaving out any contained in another space. The spaces
+    # kept from before the split were maximal and each new one lies inside a space they did
+    # not contain, so only the new spaces can be redundant. Returns the spaces added
+    def merge_spaces(self, new_spaces):
+        # Larger spaces first, so a space is only checked against those that could contain it
+        new_spaces = sorted(set(new_spaces), key=lambda space: (-space_volume(space), space))
+        grid = self._grid
+        added = []
+        for new_space in new_spaces:
+            if grid is None:
+                contained = any_contains(self.available_spaces, new_space)
+            else:
+                contained = grid.any_containing(new_space)
+            if contained:
+                continue
+            self._insert_space(new_space)
+            added.append(new_space)
+        return added
 
     # Perform an action by placing a box, and return a new State
     def perform_action(self, action):
         # Clone the current state to avoid modifying the original
         new_state = self.clone()
+        new_state._place(action)
+        return new_state  # Return the new state
+
+    # Perform an action in place without recording an undo delta, for states that are
+    # thrown away afterwards such as a rollout's scratch copy
+    def play(self, action):
+        self._place(action)
+
+    # Perform an action in place, recording a delta so it can be reverted with undo()
+    def apply(self, action):
+        box = action[0]
+        box_index = self.boxes_to_place.index(box) if box in self.boxes_to_place else None
+        # Only the spaces the placement removed and added are kept, to be swapped back
+        removed, added = self._place(action)
+        self._undo_stack.append((removed, added, box_index))
+
+    # Revert the most recent apply() and return the action that was undone
+    def undo(self):
+        removed, added, box_index = self._undo_stack.pop()
+        action = self.action_history.pop()
+        self.placed_volume -= action[0].width * action[0].height * action[0].depth
+        if box_index is not None and action[0] not in self.boxes_to_place:
+            self.boxes_to_place.insert(box_index, action[0])
+            self._count_box(action[0].get_shape(), 1)
+        for space in added:
+            self._discard_space(space)
+        for space in removed:
+            self._insert_space(space)
+        return action
+
+    # Place a box on this state without cloning, and return the spaces removed and added
+    def _place(self, action):
         box, position, rotation = action
-        new_state.action_history.append((box, position, rotation))  # Record the action
+        self.action_history.append((box, position, rotation))  # Record the action
+        self.placed_volume += box.width * box.height * box.depth
         # Find the space where the box is placed
-        space = None
-        for s in new_state.available_spaces:
-            if s[0] == position and new_state.can_place_item(s, rotation):
-                space = s
-                break
+        space = self._first_fit_at(position, rotation)
         if space is None:
             # This should not happen, but just in case
-            return new_state
-        new_state.split(space, box, position, rotation)
-        new_state.boxes_to_place.remove(box)
-        # Optionally merge adjacent spaces
-        new_state.merge_spaces()
-        return new_state  # Return the new state
+            return [], []
+        changes = self.split(space, box, position, rotation)
+        self.remove_box(box)
+        return changes
 
-    # Merge adjacent free spaces (optional, not implemented)
-    def merge_spaces(self):
-        # Implement logic to merge adjacent or overlapping spaces if desired
-        pass
+    # The most volume any packing continuing from this state can fill: what is placed, plus
+    # whichever is smallest of the usable free volume, the volume not yet placed and the
+    # volume of the boxes left. Every later box lies inside a current space, so the usable
+    # free volume is at most the total volume of the spaces, overlaps counted twice, less
+    # that of any too thin for the smallest remaining box
+    def upper_bound(self):
+        usable_volume = self.free_volume - self.dead_volume()
+        unplaced_volume = self.width * self.height * self.depth - self.placed_volume
+        return self.placed_volume + min(usable_volume, unplaced_volume, self.remaining_volume)
+
+    # Volume of the spaces whose thinnest side is smaller than the smallest side of every
+    # remaining box, so no box can ever be placed in them. The total is kept up to date as
+    # spaces change, and only summed over every space again when the smallest side has
+    # changed since it was last worked out
+    def dead_volume(self):
+        if not self._short_sides:
+            return self.free_volume
+        smallest = min(self._short_sides)
+        if smallest != self._dead_side:
+            self._dead_side = smallest
+            self._dead_volume = sum(self._space_dead(space) for space in self.available_spaces)
+        return self._dead_volume
+
+    # The volume of a space if it is too thin for the smallest side _dead_side, or else 0
+    def _space_dead(self, space):
+        if self._dead_side is None:
+            return 0
+        (x0, y0, z0), (x1, y1, z1) = space
+        if min(x1 - x0, y1 - y0, z1 - z0) < self._dead_side:
+            return space_volume(space)
+        return 0
 
     # Evaluate the current state by computing total volume and penalizing the number of boxes placed
     def evaluation(self):
@@ -166,9 +645,17 @@ class State:
 
         return self.evaluation() < other.evaluation()
 
-    # Define equality comparison for State
+    # Define equality comparison for State: the same available spaces and the same remaining
+    # box shapes, however the boxes were placed to get there
     def __eq__(self, other):
         if not isinstance(other, State):
             return NotImplemented
 
-        return self.evaluation() == other.evaluation()
+        if self._hash != other._hash:
+            return False
+        # Rule out hash collisions
+        return self.available_spaces == other.available_spaces and self.box_counts == other.box_counts
+
+    # Zobrist hash, consistent with __eq__
+    def __hash__(self):
+        return self._hash
@@ -88,27 +88,21 @@ def ffdh_packing(boxes, width, height):
     while state.boxes_to_place:
         box = state.boxes_to_place[0]  # Always select the next box in the sorted list
         placed = False
-        rotations = box.get_rotations()
-        # Try to place the box in existing layers
-        for rotation in rotations:
-            for layer in sorted(state.available_spaces.keys()):
-                intervals = state.available_spaces[layer]
-                for interval in intervals:
-                    if state.can_place_item(layer, interval, rotation):
-                        action = (box, layer, interval, rotation)
-                        state = state.perform_action(action)
-                        # Visualization
-                        step += 1
-                        plot_state(state, f"Step {step}", save_filename=f"step_{step}.png")
-                        placed = True
-                        break
-                if placed:
-                    break
-            if placed:
+        # Try to place the box in the lowest existing layer it fits in
+        for rotation in box.get_rotations():
+            fit = state.first_fit(rotation)
+            if fit is not None:
+                layer, interval = fit
+                action = (box, layer, interval, rotation)
+                state = state.perform_action(action)
+                # Visualization
+                step += 1
+                plot_state(state, f"Step {step}", save_filename=f"step_{step}.png")
+                placed = True
                 break
         if not placed:
             # Cannot place the box; remove it
-            state.boxes_to_place.remove(box)
+            state.remove_box(box)
     return state
 
 def main():
@@ -1,8 +1,32 @@
+import random
+from bisect import bisect_left, bisect_right, insort
 from typing import List, Dict, Tuple
 
+import numpy as np
+
 # Define the penalty factor globally
 penalty_factor = 1000  # Adjust this value as needed
 
+# Above this many (shape, free interval) pairs, sample_action draws from the NumPy feasibility mask
+vectorise_threshold = 500
+
+# Proposals sample_action rejects before falling back to enumerating every legal action
+sample_attempts = 8
+
+# Zobrist keys: a 64-bit key per state feature, given as a tuple of integers (and nested tuples
+# of them) whose first item is one of the feature tags below. Hashes of integer tuples are not
+# salted per process the way string hashes are, so scrambling the tuple hash with the splitmix64
+# finaliser gives a feature the same key in every process and run, and no key is stored
+free_feature = 0  # (free_feature, layer, start, end): a free interval
+boxes_feature = 1  # (boxes_feature, shape, count): count boxes of a shape left
+_mask = (1 << 64) - 1
+
+def zobrist_key(feature):
+    key = (hash(feature) + 0x9E3779B97F4A7C15) & _mask
+    key = ((key ^ (key >> 30)) * 0xBF58476D1CE4E5B9) & _mask
+    key = ((key ^ (key >> 27)) * 0x94D049BB133111EB) & _mask
+    return key ^ (key >> 31)
+
 # Box class representing a rectangle to be packed
 class Box:
     def __init__(self, width: int, height: int, box_id: int):
@@ -10,10 +34,16 @@ class Box:
         self.height = height
         self.id = box_id
 
-    # Returns possible rotations (width, height) and (height, width)
+    # Returns possible rotations (width, height) and (height, width), once for square boxes
     def get_rotations(self):
+        if self.width == self.height:
+            return [(self.width, self.height)]
         return [(self.width, self.height), (self.height, self.width)]
 
+    # Returns the rotation-independent shape used to group interchangeable boxes
+    def get_shape(self):
+        return (min(self.width, self.height), max(self.width, self.height))
+
     # Define equality comparison for Box based on id
     def __eq__(self, other):
         if isinstance(other, Box):
@@ -38,33 +68,231 @@ class State:
         self.boxes_to_place = [item for item in boxes_to_place]
         self.action_history = [item for item in action_history]  # Keeps track of placed boxes
         self.available_spaces = {key:available_spaces.get(key) for key in available_spaces.keys()} # Initially entire width available at layer 0
+        self._undo_stack = []  # Deltas recorded by apply() so placements can be undone in place
+        self._dirty_layers = set(self.available_spaces)  # Layers that may still be unsorted or unmerged
+        self.box_types = {}  # Remaining boxes grouped by shape, so identical boxes share actions
+        self._short_sides = {}  # Number of remaining boxes by their shorter side
+        for box in self.boxes_to_place:
+            self.box_types.setdefault(box.get_shape(), []).append(box)
+            self._count_short_side(box, 1)
+        # Every free interval as (width, layer, start), sorted so fitting intervals can be found by width
+        self._free_index = sorted(
+            (end - start, layer, start) for layer, intervals in self.available_spaces.items() for start, end in intervals
+        )
+        # Zobrist hash of the free intervals and the remaining box counts, kept up to date incrementally
+        self._hash = 0
+        for width, layer, start in self._free_index:
+            self._hash ^= zobrist_key((free_feature, layer, start, start + width))
+        for shape, boxes in self.box_types.items():
+            self._hash_box_count(shape, len(boxes))
+        # Areas behind upper_bound(), also kept up to date incrementally. The free intervals
+        # partition the width, so the free area is each interval's width times its height
+        # to the top of the container
+        self.placed_area = sum(rotation[0] * rotation[1] for _, _, _, rotation in self.action_history)
+        self.remaining_area = sum(box.width * box.height for box in self.boxes_to_place)
+        self.free_area = sum(width * (self.height - layer) for width, layer, _ in self._free_index)
+        # The free intervals again, as (start, end, layer) sorted left to right
+        self._skyline = sorted((start, start + width, layer) for width, layer, start in self._free_index)
+        # Dead area of the skyline for the smallest remaining side it was worked out for, kept up
+        # to date by _reindex_layer; None until dead_area() first works it out
+        self._dead_side = None
+        self._dead_area = 0
 
     # Clone the state (deepcopy)
-# Clone the state (deepcopy)
     def clone(self):
-        return State(
+        new_state = State(
             self.width,
             self.height,
             self.boxes_to_place.copy(),
             self.action_history.copy(),
             {layer: intervals.copy() for layer, intervals in self.available_spaces.items()}
         )
-
+        new_state._dirty_layers = self._dirty_layers.copy()
+        new_state._dead_side = self._dead_side
+        new_state._dead_area = self._dead_area
+        return new_state
 
     def add_box(self, box: Box):
         self.boxes_to_place.append(box)
+        self._insert_box_type(box, None)
+
+    # Remove a box that will not be placed
+    def remove_box(self, box: Box):
+        self.boxes_to_place.remove(box)
+        self.remaining_area -= box.width * box.height
+        self._count_short_side(box, -1)
+        boxes = self.box_types[box.get_shape()]
+        self._hash_box_count(box.get_shape(), len(boxes))
+        boxes.remove(box)
+        self._hash_box_count(box.get_shape(), len(boxes))
+
+    # Add a box to its shape group, at the end or at a given index
+    def _insert_box_type(self, box: Box, index):
+        boxes = self.box_types.setdefault(box.get_shape(), [])
+        self.remaining_area += box.width * box.height
+        self._count_short_side(box, 1)
+        self._hash_box_count(box.get_shape(), len(boxes))
+        if index is None:
+            boxes.append(box)
+        else:
+            boxes.insert(index, box)
+        self._hash_box_count(box.get_shape(), len(boxes))
+
+    # Change the number of remaining boxes with this box's shorter side
+    def _count_short_side(self, box: Box, change):
+        side = min(box.width, box.height)
+        count = self._short_sides.get(side, 0) + change
+        if count:
+            self._short_sides[side] = count
+        else:
+            del self._short_sides[side]
 
-    # Get all possible actions (box, layer, interval, rotation) that can be performed
+    # Toggle the Zobrist key for there being count boxes of a shape left
+    def _hash_box_count(self, shape, count):
+        if count:
+            self._hash ^= zobrist_key((boxes_feature, shape, count))
+
+    # Get all possible actions (box, layer, interval, rotation) that can be performed.
+    # Boxes of the same shape are interchangeable, so only the first of each shape is used
     def get_possible_actions(self):
-        actions = []
-        for box in self.boxes_to_place:
-            rotations = box.get_rotations()  # Get possible rotations
-            for layer, intervals in self.available_spaces.items():
-                for interval in intervals:
-                    for rotation in rotations:
-                        if self.can_place_item(layer, interval, rotation):
-                            actions.append((box, layer, interval, rotation))  # Possible actions
-        return actions
+        return list(self.iter_actions())
+
+    # Yield the same actions as get_possible_actions, one at a time, so a caller that only
+    # needs the first few never builds the rest. The state must not change while iterating
+    def iter_actions(self):
+        free_index = self._free_index
+        for boxes in self.box_types.values():
+            if not boxes:
+                continue
+            box = boxes[0]
+            for rotation in box.get_rotations():
+                max_layer = self.height - rotation[1]
+                # Only intervals at least as wide as the box are visited
+                for width, layer, start in free_index[bisect_left(free_index, (rotation[0],)):]:
+                    if layer <= max_layer:
+                        yield (box, layer, (start, start + width), rotation)  # Possible actions
+
+    # Every legal action, best first by a cheap prior: larger boxes first, then lower layers,
+    # then tighter fits, leaving less of the interval beside the box
+    def prioritised_actions(self):
+        return sorted(self.iter_actions(), key=lambda action: (-action[3][0] * action[3][1], action[1], action[2][1] - action[2][0] - action[3][0]))
+
+    # Identify an action by what it does rather than which box it uses, so the same move made
+    # with interchangeable boxes, or in different orders, is recognised as one
+    @staticmethod
+    def action_key(action):
+        box, layer, interval, rotation = action
+        return (box.get_shape(), layer, interval[0], rotation)
+
+    # True if no box can be placed, found without listing the actions
+    def is_terminal(self):
+        return next(self.iter_actions(), None) is None
+
+    # Check every (shape, rotation, free interval) combination in one broadcast operation.
+    # Returns the representative box of each shape, the (shape, rotation, 2) array of rotated
+    # dimensions, the (interval, 3) array of (width, layer, start) free intervals, and the
+    # shape, rotation and interval index arrays of the combinations that fit
+    def action_arrays(self):
+        boxes = [boxes[0] for boxes in self.box_types.values() if boxes]
+        dimensions = np.array([(box.width, box.height) for box in boxes], dtype=np.int64).reshape(-1, 2)
+        rotations = np.stack((dimensions, dimensions[:, ::-1]), axis=1)
+        free = np.array(self._free_index, dtype=np.int64).reshape(-1, 3)
+        fits = (
+            (rotations[:, :, 0, None] <= free[None, None, :, 0])
+            & (rotations[:, :, 1, None] + free[None, None, :, 1] <= self.height)
+        )
+        # Square boxes only have one distinct rotation
+        fits[:, 1, :] &= (dimensions[:, 0] != dimensions[:, 1])[:, None]
+        shape_indices, rotation_indices, interval_indices = np.nonzero(fits)
+        return boxes, rotations, free, shape_indices, rotation_indices, interval_indices
+
+    # Same actions, in the same order, as get_possible_actions, built from action_arrays()
+    def get_possible_actions_vectorised(self):
+        boxes, rotations, free, shape_indices, rotation_indices, interval_indices = self.action_arrays()
+        rotation_list = [[tuple(rotation) for rotation in box_rotations] for box_rotations in rotations.tolist()]
+        placements = [(layer, (start, start + width)) for width, layer, start in self._free_index]
+        return [
+            (boxes[shape_index], placements[interval_index][0], placements[interval_index][1], rotation_list[shape_index][rotation_index])
+            for shape_index, rotation_index, interval_index
+            in zip(shape_indices.tolist(), rotation_indices.tolist(), interval_indices.tolist())
+        ]
+
+    # Pick a uniformly random legal action, or None if there is none. A (rotation, free
+    # interval at least as wide) pair is proposed uniformly from the width index, which only
+    # takes a binary search per rotation, and accepted if the box also fits under the top of
+    # the container. Accepted pairs are uniform over the legal actions, and only the chosen
+    # action is built. After sample_attempts rejections every legal action is enumerated
+    # instead, from the action_arrays() mask on large states
+    def sample_action(self, rng=random):
+        free_index = self._free_index
+        n_free = len(free_index)
+        proposals = []
+        cumulative = []
+        total = 0
+        for boxes in self.box_types.values():
+            if not boxes:
+                continue
+            for rotation in boxes[0].get_rotations():
+                fitting = n_free - bisect_left(free_index, (rotation[0],))
+                if fitting:
+                    total += fitting
+                    proposals.append((boxes[0], rotation, n_free - total))
+                    cumulative.append(total)
+        if not total:
+            return None
+        for _ in range(sample_attempts):
+            r = int(rng.random() * total)
+            box, rotation, offset = proposals[bisect_right(cumulative, r)]
+            width, layer, start = free_index[offset + r]
+            if layer + rotation[1] <= self.height:
+                return (box, layer, (start, start + width), rotation)
+        if len(self.box_types) * len(free_index) <= vectorise_threshold:
+            actions = self.get_possible_actions()
+            return rng.choice(actions) if actions else None
+        boxes, rotations, free, shape_indices, rotation_indices, interval_indices = self.action_arrays()
+        if len(shape_indices) == 0:
+            return None
+        i = rng.randrange(len(shape_indices))
+        width, layer, start = free[interval_indices[i]].tolist()
+        rotation = tuple(rotations[shape_indices[i], rotation_indices[i]].tolist())
+        return (boxes[shape_indices[i]], layer, (start, start + width), rotation)
+
+    # Yield (layer, interval) for every free interval a box with this rotation fits in.
+    # Intervals too narrow for the box are skipped by binary search on the width index
+    def fitting_intervals(self, rotation: Tuple[int, int]):
+        box_width, box_height = rotation
+        max_layer = self.height - box_height
+        free_index = self._free_index
+        for width, layer, start in free_index[bisect_left(free_index, (box_width,)):]:
+            if layer <= max_layer:
+                yield layer, (start, start + width)
+
+    # Return the lowest, then leftmost, (layer, interval) a box with this rotation fits in, or None
+    def first_fit(self, rotation: Tuple[int, int]):
+        return min(self.fitting_intervals(rotation), default=None)
+
+    # The action ffdh_packing would take next: the largest-area box that still fits, trying its
+    # rotations in order, in the lowest layer it fits in
+    def largest_first_action(self):
+        shapes = sorted((shape for shape, boxes in self.box_types.items() if boxes), key=lambda shape: shape[0] * shape[1], reverse=True)
+        for shape in shapes:
+            box = self.box_types[shape][0]
+            for rotation in box.get_rotations():
+                fit = self.first_fit(rotation)
+                if fit is not None:
+                    return (box, fit[0], fit[1], rotation)
+        return None
+
+    # Bottom-left fill: the lowest, then leftmost, free interval any box fits in, filled with
+    # the largest-area box that fits there
+    def lowest_fit_action(self):
+        boxes = sorted((boxes[0] for boxes in self.box_types.values() if boxes), key=lambda box: box.width * box.height, reverse=True)
+        for layer, start, width in sorted((layer, start, width) for width, layer, start in self._free_index):
+            for box in boxes:
+                for rotation in box.get_rotations():
+                    if rotation[0] <= width and layer + rotation[1] <= self.height:
+                        return (box, layer, (start, start + width), rotation)
+        return None
 
     # Check if the box can be placed in a specified layer and interval
     def can_place_item(self, layer, interval: Tuple[int, int], rotation: Tuple[int, int]):
@@ -77,40 +305,146 @@ class State:
     # Split the space after placing the box
     def split(self, layer, interval, box, rotation):
         box_width, box_height = rotation
-        new_intervals = []
+        intervals = self.available_spaces[layer]
+        index = self._interval_index(layer, interval)
 
-        # Update the space at the current layer (horizontal split)
+        # Update the space at the current layer (horizontal split), keeping its sorted position
         if interval[0] + box_width < interval[1]:
-            new_intervals.append((interval[0] + box_width, interval[1]))  # Remaining space in the interval
-
-        self.available_spaces[layer].remove(interval)
-        self.available_spaces[layer].extend(new_intervals)
+            intervals[index] = (interval[0] + box_width, interval[1])  # Remaining space in the interval
+        else:
+            del intervals[index]
 
         # Add new space to the next layer if box extends vertically
         if box_height > 0:
             new_layer = layer + box_height
             if new_layer not in self.available_spaces:
                 self.available_spaces[new_layer] = []
-            self.available_spaces[new_layer].append((interval[0], interval[0] + box_width))
+            self._insert_interval(new_layer, (interval[0], interval[0] + box_width))
+
+    # Locate an interval in its layer, by binary search once the layer is sorted
+    def _interval_index(self, layer, interval):
+        intervals = self.available_spaces[layer]
+        if layer in self._dirty_layers:
+            return intervals.index(interval)
+        index = bisect_left(intervals, interval)
+        if index == len(intervals) or intervals[index] != interval:
+            raise ValueError(f'{interval} is not a free interval of layer {layer}')
+        return index
+
+    # Insert an interval into a sorted layer, coalescing it with adjacent neighbours
+    def _insert_interval(self, layer, interval):
+        intervals = self.available_spaces[layer]
+        if layer in self._dirty_layers:
+            intervals.append(interval)
+            return
+        start, end = interval
+        index = bisect_left(intervals, interval)
+        if index > 0 and intervals[index - 1][1] == start:
+            index -= 1
+            start = intervals.pop(index)[0]
+        if index < len(intervals) and intervals[index][0] == end:
+            end = intervals.pop(index)[1]
+        intervals.insert(index, (start, end))
 
     # Perform an action by placing a box, and return a new State
     def perform_action(self, action):
         # Clone the current state to avoid modifying the original
         new_state = self.clone()
-        box, layer, interval, rotation = action
-        new_state.action_history.append(action)  # Record the action
-        new_state.split(layer, interval, box, rotation)
-        new_state.boxes_to_place.remove(box)
-        new_state.merge()  # Merge adjacent intervals
+        new_state._place(action)
         return new_state  # Return the new state
 
-    # Merge adjacent free intervals
+    # Perform an action in place without recording an undo delta, for states that are
+    # thrown away afterwards such as a rollout's scratch copy
+    def play(self, action):
+        self._place(action)
+
+    # Perform an action in place, recording a delta so it can be reverted with undo()
+    def apply(self, action):
+        self.merge()  # Settle any unmerged layers first so the delta below captures every change
+        box, layer, interval, rotation = action
+        new_layer = layer + rotation[1]
+        # Only the split layer and the layer on top of the box change, so those are all we keep
+        delta = (
+            layer,
+            self.available_spaces[layer].copy(),
+            new_layer,
+            self.available_spaces[new_layer].copy() if new_layer in self.available_spaces else None,
+            self.boxes_to_place.index(box),
+            self.box_types[box.get_shape()].index(box),
+        )
+        self._place(action)
+        self._undo_stack.append(delta)
+
+    # Revert the most recent apply() and return the action that was undone
+    def undo(self):
+        layer, layer_intervals, new_layer, new_layer_intervals, box_index, type_index = self._undo_stack.pop()
+        action = self.action_history.pop()
+        self.placed_area -= action[3][0] * action[3][1]
+        changed_intervals = self.available_spaces[new_layer]
+        if new_layer_intervals is None:
+            del self.available_spaces[new_layer]
+        else:
+            self.available_spaces[new_layer] = new_layer_intervals
+        self._reindex_layer(new_layer, changed_intervals)
+        if layer != new_layer:
+            changed_intervals = self.available_spaces[layer]
+            self.available_spaces[layer] = layer_intervals
+            self._reindex_layer(layer, changed_intervals)
+        self.boxes_to_place.insert(box_index, action[0])
+        self._insert_box_type(action[0], type_index)
+        return action
+
+    # Place a box on this state without cloning
+    def _place(self, action):
+        box, layer, interval, rotation = action
+        new_layer = layer + rotation[1]
+        layer_intervals = list(self.available_spaces[layer])
+        new_layer_intervals = list(self.available_spaces.get(new_layer, ()))
+        self.action_history.append(action)  # Record the action
+        self.placed_area += rotation[0] * rotation[1]
+        self.split(layer, interval, box, rotation)
+        self._reindex_layer(layer, layer_intervals)
+        if new_layer != layer:
+            self._reindex_layer(new_layer, new_layer_intervals)
+        self.remove_box(box)
+        self.merge()  # Merge any layers still marked dirty
+
+    # Bring the width index up to date for a layer whose intervals used to be old_intervals
+    def _reindex_layer(self, layer, old_intervals):
+        old_intervals = set(old_intervals)
+        new_intervals = set(self.available_spaces.get(layer, ()))
+        tracking = self._dead_side is not None
+        for start, end in old_intervals - new_intervals:
+            del self._free_index[bisect_left(self._free_index, (end - start, layer, start))]
+            self._hash ^= zobrist_key((free_feature, layer, start, end))
+            self.free_area -= (end - start) * (self.height - layer)
+            # Removing a skyline interval changes whether its neighbours are walled in
+            index = bisect_left(self._skyline, (start, end, layer))
+            if tracking:
+                self._dead_area -= self._dead_at(index - 1) + self._dead_at(index) + self._dead_at(index + 1)
+            del self._skyline[index]
+            if tracking:
+                self._dead_area += self._dead_at(index - 1) + self._dead_at(index)
+        for start, end in new_intervals - old_intervals:
+            insort(self._free_index, (end - start, layer, start))
+            self._hash ^= zobrist_key((free_feature, layer, start, end))
+            self.free_area += (end - start) * (self.height - layer)
+            index = bisect_left(self._skyline, (start, end, layer))
+            if tracking:
+                self._dead_area -= self._dead_at(index - 1) + self._dead_at(index)
+            self._skyline.insert(index, (start, end, layer))
+            if tracking:
+                self._dead_area += self._dead_at(index - 1) + self._dead_at(index) + self._dead_at(index + 1)
+
+    # Merge adjacent free intervals. split() keeps layers sorted and merged as it goes,
+    # so only layers marked dirty (e.g. passed in to the constructor) need the full pass
     def merge(self):
-        for layer in self.available_spaces:
+        for layer in self._dirty_layers:
             merged_intervals = []
             intervals = sorted(self.available_spaces[layer])  # Sort the intervals by start point
             if not intervals:
                 continue
+            old_intervals = self.available_spaces[layer]
             current_start, current_end = intervals[0]
 
             for start, end in intervals[1:]:
@@ -122,6 +456,45 @@ class State:
 
             merged_intervals.append((current_start, current_end))  # Append the last interval
             self.available_spaces[layer] = merged_intervals
+            self._reindex_layer(layer, old_intervals)
+        self._dirty_layers.clear()
+
+    # The most area any packing continuing from this state can cover: what is placed, plus
+    # whichever is smaller of the usable free area and the area of the boxes left. Placing a
+    # box never leaves a gap under it, so the plain free area always makes up the rest of the
+    # container; the dead area is taken off to give a bound that tightens as the packing goes
+    def upper_bound(self):
+        return self.placed_area + min(self.free_area - self.dead_area(), self.remaining_area)
+
+    # Free area no remaining box can ever use: intervals closer to the top than the smallest
+    # remaining box side, and intervals narrower than it between two higher neighbours (or a
+    # wall), which can never merge into a wider one. Layers only rise and the smallest side
+    # only grows as boxes are placed, so dead area stays dead. The total is kept up to date
+    # as intervals change, and only summed over the whole skyline again when the smallest
+    # side has changed since it was last worked out
+    def dead_area(self):
+        if not self._short_sides:
+            return self.free_area
+        smallest = min(self._short_sides)
+        if smallest != self._dead_side:
+            self._dead_side = smallest
+            self._dead_area = sum(self._dead_at(i) for i in range(len(self._skyline)))
+        return self._dead_area
+
+    # Dead area of the skyline interval at index i for the smallest side _dead_side, or 0 if
+    # the index is off either end of the skyline
+    def _dead_at(self, i):
+        skyline = self._skyline
+        if i < 0 or i >= len(skyline):
+            return 0
+        start, end, layer = skyline[i]
+        if layer + self._dead_side > self.height or (
+            end - start < self._dead_side
+            and (i == 0 or skyline[i - 1][2] > layer)
+            and (i == len(skyline) - 1 or skyline[i + 1][2] > layer)
+        ):
+            return (end - start) * (self.height - layer)
+        return 0
 
     # Evaluate the current state by computing total area and remaining available space
     def evaluation(self):
@@ -148,10 +521,20 @@ class State:
         else:  # If both are equal, compare least_layer
             return self_eval[2] < other_eval[2]
 
-    # Define equality comparison for State
+    # Define equality comparison for State: the same free intervals and the same remaining
+    # box shapes, however the boxes were placed to get there
     def __eq__(self, other):
         if not isinstance(other, State):
             return NotImplemented
 
-        # Compare based on evaluation
-        return self.evaluation() == other.evaluation()
\ No newline at end of file
+        if self._hash != other._hash or self.height != other.height:
+            return False
+        # Rule out hash collisions
+        return self._free_index == other._free_index and self._box_counts() == other._box_counts()
+
+    # Zobrist hash, consistent with __eq__
+    def __hash__(self):
+        return self._hash
+
+    def _box_counts(self):
+        return {shape: len(boxes) for shape, boxes in self.box_types.items() if boxes}
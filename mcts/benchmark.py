@@ -0,0 +1,168 @@
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import state as state_module
+from state import State, Box
+from monte import mcts, MCTSNode, Rave
+
+# Generate boxes of random size, as in simulation.py, without importing matplotlib
+def generate_random_boxes(n_boxes: int, max_width: int, max_height: int):
+    return [Box(random.randint(1, max_width), random.randint(1, max_height), i) for i in range(1, n_boxes + 1)]
+
+# Pick the lowest-layer first-fit action for the next box, without timing it
+def first_fit_action(state: State):
+    box = state.boxes_to_place[0]
+    for rotation in box.get_rotations():
+        fit = state.first_fit(rotation)
+        if fit is not None:
+            return (box, fit[0], fit[1], rotation)
+    return None
+
+# Time in-place placements as the container (and so the number of layers) grows taller
+def bench_placement_vs_height(heights=(10, 100, 1000, 10000), width=20, placements=2000):
+    print('Per-placement cost vs container height')
+    print(f'{"height":>8} {"layers":>8} {"us/placement":>14}')
+    for height in heights:
+        random.seed(0)
+        state = State(width, height)
+        for box in generate_random_boxes(placements * 4, 5, 5):
+            state.add_box(box)
+        elapsed = 0.0
+        placed = 0
+        while placed < placements and state.boxes_to_place:
+            action = first_fit_action(state)
+            if action is None:
+                state.remove_box(state.boxes_to_place[0])
+                continue
+            start_time = time.perf_counter()
+            state.apply(action)
+            elapsed += time.perf_counter() - start_time
+            placed += 1
+        print(f'{height:>8} {len(state.available_spaces):>8} {1e6 * elapsed / max(placed, 1):>14.2f}')
+
+# Time get_possible_actions and count the actions it returns as the number of boxes grows
+def bench_action_generation(box_counts=(30, 100, 300, 1000), width=10, height=10, repeats=50):
+    print('get_possible_actions vs number of boxes')
+    print(f'{"boxes":>8} {"shapes":>8} {"actions":>8} {"us/call":>10}')
+    for n_boxes in box_counts:
+        random.seed(0)
+        state = State(width, height, generate_random_boxes(n_boxes, 5, 5))
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            actions = state.get_possible_actions()
+        elapsed = time.perf_counter() - start_time
+        shapes = sum(1 for boxes in state.box_types.values() if boxes)
+        print(f'{n_boxes:>8} {shapes:>8} {len(actions):>8} {1e6 * elapsed / repeats:>10.2f}')
+
+# Compare drawing one random action through the Python action list and the NumPy feasibility mask
+def bench_sample_action(instances=((10, 10, 8, 5), (50, 50, 100, 5), (100, 100, 40, 20), (300, 300, 300, 20)), repeats=50):
+    print('sample_action: Python list vs NumPy mask')
+    print(f'{"container":>10} {"pairs":>8} {"python us":>10} {"numpy us":>10}')
+    threshold = state_module.vectorise_threshold
+    for width, height, placements, max_size in instances:
+        random.seed(0)
+        state = State(width, height, generate_random_boxes(placements + 2000, max_size, max_size))
+        for _ in range(placements):
+            action = state.sample_action()
+            if action is None:
+                break
+            state.apply(action)
+        timings = []
+        for forced_threshold in (float('inf'), -1):
+            state_module.vectorise_threshold = forced_threshold
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                state.sample_action()
+            timings.append(1e6 * (time.perf_counter() - start_time) / repeats)
+        pairs = len(state.box_types) * len(state._free_index)
+        print(f'{width:>4}x{height:<5} {pairs:>8} {timings[0]:>10.1f} {timings[1]:>10.1f}')
+    state_module.vectorise_threshold = threshold
+
+# Time one root-parallel move at a fixed total iteration count for increasing worker counts
+def bench_root_parallel(worker_counts=(1, 2, 4, 8), iterations=4000, n_boxes=30):
+    random.seed(0)
+    state = State(10, 10, generate_random_boxes(n_boxes, 5, 5))
+    print(f'Root-parallel mcts: {iterations} iterations on {n_boxes} boxes')
+    print(f'{"workers":>8} {"seconds":>10} {"speedup":>8}')
+    baseline = None
+    for workers in worker_counts:
+        executor = ProcessPoolExecutor(workers) if workers > 1 else None
+        if executor is not None:
+            mcts(state, iterations=workers, workers=workers, executor=executor)  # Start the worker processes before timing
+        start_time = time.perf_counter()
+        mcts(state, iterations=iterations, workers=workers, executor=executor)
+        elapsed = time.perf_counter() - start_time
+        if executor is not None:
+            executor.shutdown()
+        baseline = baseline or elapsed
+        print(f'{workers:>8} {elapsed:>10.2f} {baseline / elapsed:>8.2f}')
+
+# A rollout that lists every legal action at each step and places boxes with apply(),
+# to compare against the sampling kernel in MCTSNode.rollout
+def listing_rollout(state: State):
+    state = state.clone()
+    actions = state.get_possible_actions()
+    while actions:
+        state.apply(random.choice(actions))
+        actions = state.get_possible_actions()
+    return MCTSNode.evaluate_state(state)
+
+# Rollouts per second from a fresh packing, with the listing rollout and the sampling kernel
+def bench_rollouts(instances=((10, 10, 30, 5), (50, 50, 200, 8)), seconds=2.0):
+    print('Rollouts per second: listing every action vs sampling one')
+    print(f'{"container":>10} {"boxes":>6} {"listing":>10} {"sampling":>10}')
+    for width, height, n_boxes, max_size in instances:
+        random.seed(0)
+        node = MCTSNode(State(width, height, generate_random_boxes(n_boxes, max_size, max_size)))
+        rates = []
+        for rollout in (lambda: listing_rollout(node.state), node.rollout):
+            rollouts = 0
+            start_time = time.perf_counter()
+            while time.perf_counter() - start_time < seconds:
+                rollout()
+                rollouts += 1
+            rates.append(rollouts / (time.perf_counter() - start_time))
+        print(f'{width:>4}x{height:<5} {n_boxes:>6} {rates[0]:>10.1f} {rates[1]:>10.1f}')
+
+# Pack a whole instance with one mcts() call per move, reusing the subtree each time, and
+# return the fraction of the container filled
+def pack_fill_rate(state: State, iterations, **options):
+    root_node = None
+    while not state.is_terminal():
+        action, root_node = mcts(state, iterations, root_node=root_node, return_node=True, **options)
+        state = state.perform_action(action)
+    return state.placed_area / (state.width * state.height)
+
+# Mean fill rate of plain UCT and RAVE at increasing iterations per move, and the fewest
+# iterations at which each reaches target_fill
+def bench_rave(iteration_counts=(10, 25, 50, 100, 200), target_fill=0.97, seeds=8, width=20, height=20, n_boxes=25, max_size=9):
+    print(f'UCT vs RAVE: mean fill rate over {seeds} packings of {n_boxes} boxes in {width}x{height}')
+    modes = (('uct', {}), ('rave', {'rave': Rave()}))
+    print(f'{"iterations":>10} ' + ' '.join(f'{name:>8}' for name, _ in modes))
+    reached = {}
+    for iterations in iteration_counts:
+        fill_rates = []
+        for name, options in modes:
+            total = 0.0
+            for seed in range(seeds):
+                random.seed(seed)
+                state = State(width, height, generate_random_boxes(n_boxes, max_size, max_size))
+                total += pack_fill_rate(state, iterations, **options)
+            fill_rates.append(total / seeds)
+            if total / seeds >= target_fill:
+                reached.setdefault(name, iterations)
+        print(f'{iterations:>10} ' + ' '.join(f'{fill_rate:>8.4f}' for fill_rate in fill_rates))
+    for name, _ in modes:
+        print(f'{name} reaches {target_fill:.0%} fill at {reached.get(name, "more than " + str(iteration_counts[-1]))} iterations per move')
+
+def main():
+    bench_placement_vs_height()
+    bench_action_generation()
+    bench_sample_action()
+    bench_root_parallel()
+    bench_rollouts()
+    bench_rave()
+
+if __name__ == "__main__":
+    main()
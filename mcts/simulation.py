@@ -1,5 +1,7 @@
 import random
+import time
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
 from state import State, Box
@@ -84,14 +86,36 @@ def plot_state(state: State, title: str, save_filename=None):
     else:
         plt.show()
 
-def mcts_packing(boxes, width, height, iterations_per_move=100):
+# Roughly how many more boxes will fit: the remaining boxes, scaled down by how much of
+# their total area the free area of the container could hold
+def estimate_moves_left(state: State):
+    free_area = state.width * state.height - sum(rotation[0] * rotation[1] for _, _, _, rotation in state.action_history)
+    box_area = sum(box.width * box.height for box in state.boxes_to_place)
+    n_boxes = len(state.boxes_to_place)
+    return max(1, min(n_boxes, round(n_boxes * free_area / max(box_area, 1))))
+
+# With time_budget set, the packing as a whole gets that many seconds: each move is given
+# twice its even share of the time left and stops early once its choice is settled, so the
+# time easy moves leave unused goes to the moves after them. iterations_per_move still caps
+# each move unless it is None. rollout_policy, widening, pruning, rave, max_nodes and
+# max_bytes are passed on to mcts()
+def mcts_packing(boxes, width, height, iterations_per_move=100, reuse_tree=True, workers=1, time_budget=None, rollout_policy='random', widening=None, pruning=False, rave=None, max_nodes=None, max_bytes=None):
     state = State(width, height)
     for box in boxes:
         state.add_box(box)
     step = 0
+    root_node = None
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    # With more than one worker each move is searched root-parallel, on one pool kept for the whole packing
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
     while state.boxes_to_place and state.get_possible_actions():
-        # Use MCTS to select the best action
-        best_action = mcts(state, iterations=iterations_per_move)
+        time_limit = None
+        if deadline is not None:
+            time_limit = max(deadline - time.perf_counter(), 0) * 2 / (estimate_moves_left(state) + 1)
+        # Use MCTS to select the best action, continuing from the subtree under the previous move
+        best_action, root_node = mcts(state, iterations=iterations_per_move, root_node=root_node, return_node=True, workers=workers, executor=executor, time_limit=time_limit, early_stop=deadline is not None, rollout_policy=rollout_policy, widening=widening, pruning=pruning, rave=rave, max_nodes=max_nodes, max_bytes=max_bytes)
+        if not reuse_tree:
+            root_node = None
         if best_action:
             state = state.perform_action(best_action)
             # Plot the current state and save it as an image
@@ -99,6 +123,8 @@ def mcts_packing(boxes, width, height, iterations_per_move=100):
             plot_state(state, f"Step {step}", save_filename=f"step_{step}.png")
         else:
             break  # No valid actions available
+    if executor is not None:
+        executor.shutdown()
     return state
 
 def main():